@@ -7,18 +7,31 @@
 
 import os
 import re
+import sys
 import time
 import shutil
+import fnmatch
 import traceback
 import importlib
 
 import shared
 import timewatch
+import rundb
 import scheduler
+import app_table
+import devices
+from journal import Journal
+from schedule_cache import ScheduleCache
+from watcher import FileWatcher
+from deadlines import DeadlineQueue
+from sampler import Sampler
+from metrics import METRICS, MetricsOutput
+from profiler import PROFILE
+from supervisor import SUPERVISOR, parse_weights
 
 
 from shared import aprint
-from sd.chronology import convert_user_time, fmt_time
+from sd.chronology import convert_user_time, fmt_time, seconds_since_midnight
 
 from sd.msgbox import msgbox
 from sd.columns import auto_cols
@@ -30,9 +43,9 @@ from sd.common import itercount, gohome, rfs, mkdir, warn, spawn, search_list, D
 if importlib.util.find_spec("psutil"):
     import how_busy_psutil as how_busy
 else:
-    import how_busy_linux as how_busy       # Returns 0 if system utility not available
+    import how_busy_linux as how_busy       # Reads /proc directly
     if shared.PLATFORM == 'linux':
-        print("psutil not available... using linux system utilities.")
+        print("psutil not available... reading system usage from /proc.")
     else:
         print("Please install psutil to get system monitoring.")
 
@@ -47,17 +60,41 @@ def parse_args():
 
     args = [\
     ['polling', 'polling', str, '1'],
-    "How often to check (minutes)",
+    "How often to recheck requirements that can change at any time like cpu or lid state (minutes)",
+    ['maxsleep', '', str, '10'],
+    "Longest time to sleep when no apps are due to run (minutes). Idle time is still checked every --polling",
     ['idle', '', str],
     "How long to wait before going to sleep while plugged in.",
     ['idlebatt', '', str],
     "How long to wait before going to sleep on battery power.",
+    ['interfaces', '', str, '* !lo !docker* !br-* !veth* !virbr* !vnet* !tun* !tap* !wg*'],
+    '''
+    Network interfaces to count before sleeping and for network reqs that don't name any.
+    Use ! to leave some out. Tunnels are left out by default as their traffic also goes through a real interface.
+    ''',
+    ['foreign', '', bool],
+    '''
+    Leave out the cpu and disk usage of programs started by LazyCron when checking usage reqs and before sleeping.
+    Add 'total' or 'foreign' to a req to choose for just that req: disk 5M total
+    ''',
+    ['sample', '', float, 1],
+    '''
+    Seconds between samples of cpu, disk and network usage.
+    Usage is only sampled while an app has a usage req, or with --idle, --idlebatt or --metrics.
+    ''',
+    ['pressure', '', float],
+    '''
+    Don't go to sleep while cpu, io or memory pressure over the last minute is above this percent.
+    Replaces the disk and cpu usage checks before sleeping (linux 4.20+)
+    ''',
     ['verbose', '', int, 1],
     "What messages to print",
     ['testing', '', bool],
     "Do everything, but actually run the scripts.",
     ['logs', '', str, '/tmp/LazyCron_logs'],
     "What folder to put the log files in.",
+    ['state', '', str, '~/.local/state/LazyCron'],
+    "Folder to save run history in so it survives a restart. Use 'none' to disable.",
     ['reqs', '', str],
     '''
     Apply requirements to all processes (will not override existing reqs)
@@ -67,6 +104,24 @@ def parse_args():
     "Don't run apps on startup, wait <x> minutes",
     ['stagger', '', float, 0],
     "Wait x minutes between starting programs.",
+    ['metrics', '', str],
+    '''
+    Publish scheduler metrics in the Prometheus text format.
+    Give a filename ending in .prom to write it every loop for the node_exporter textfile collector,
+    or [host]:port to serve it over http (localhost by default)
+    ''',
+    ['profile', '', float, 0],
+    '''
+    Time each part of the main loop, count the programs and threads started and track LazyCron's own cpu time and memory.
+    A summary is printed every <x> minutes (default 60) or with the profile command in --debug mode
+    ''',
+    ['slots', '', int],
+    "Most programs to run at the same time. 0 = no limit. Same as jobs in --budgets",
+    ['budgets', '', str],
+    '''
+    Limits for named budgets used by the weight req. Programs wait in line until there is room.
+    Example: --budgets 'io 2 cpu 4 net 1'
+    ''',
     ]
 
     hidden = [\
@@ -84,57 +139,152 @@ def parse_args():
     args.idle = cut(args.idle)
     args.idlebatt = cut(args.idlebatt)
     args.polling = cut(args.polling)
+    args.maxsleep = max(cut(args.maxsleep), args.polling)
+    # Rates need at least two samples
+    args.sample = max(args.sample, 0.1)
+    if not args.state or args.state.lower() == 'none':
+        args.state = None
+    else:
+        args.state = os.path.abspath(os.path.expanduser(args.state))
+    args.budgets = parse_weights(args.budgets)
+    if args.slots is not None:
+        args.budgets['jobs'] = args.slots
 
     # Defaults if no value given
     if args.skip is None:
         args.skip = 8
     if args.verbose is None:
         args.verbose = 2
+    if args.profile is None:
+        args.profile = 60
 
     return DotDict(vars(args))
 
 
 class Busy:
-    "Poll the system to see if system is busy, returns None if value not ready yet"
-    def __init__(self, expiration=100):
-        self.expiration = expiration        # How long to keep values before querying again
-        self.net = DotDict(que=None, thread=None, timestamp=0, value=None,)
-        self.disk = DotDict(que=None, thread=None, timestamp=0, value=None,)
-        self.cpu = DotDict(que=None, thread=None, timestamp=0, value=None,)
-
-    def get_net(self, *args, **kargs):
-        return self._query(self.net, how_busy.get_network_usage, *args, **kargs)
-
-    def get_disk(self, *args, **kargs):
-        return self._query(self.disk, how_busy.all_disk_usage, *args, **kargs)
-
-    def get_cpu(self, *args, **kargs):
-        return self._query(self.cpu, how_busy.get_cpu_usage, *args, **kargs)
+    '''System usage rates from the background sampler, returns None if value not ready yet
+    foreign = leave out the cpu and disk usage of LazyCron and the programs it started'''
+    def __init__(self, window=8, sampler=None, foreign=False, interfaces='*', interval=1):
+        self.window = max(window, 2 * interval)     # Seconds to average usage over
+        self.foreign = foreign              # Default for measuring usage without our own programs
+        self.interfaces = interfaces        # Network interfaces to count when a req doesn't name them
+        self.sampler = sampler or Sampler(self.read, interval)
+        self.targets = {}                   # Device name or path to (time checked, disks)
+        self.netglobs = {interfaces: ({}, 0)}   # Interface pattern to (last counters, running total)
+        self.sampler.start()
+
+    def read(self,):
+        "Read the system counters and add a counter for each interface pattern"
+        out = how_busy.counters()
+        current = {key[4:]: val for key, val in out.items() if key.startswith('net:')}
+        for pattern, (last, total) in list(self.netglobs.items()):
+            # Only add what changed, so interfaces coming and going don't make the total jump
+            for name, val in current.items():
+                if name in last and match_interface(name, pattern):
+                    total += max(val - last[name], 0)
+            self.netglobs[pattern] = (current, total)
+            out['netglob:' + pattern] = total
+        return out
+
+    def warm(self, timeout=None):
+        "Wait for the sampler to have enough samples to compare"
+        return self.sampler.warm(timeout)
+
+    def sampling(self, needed):
+        "Only sample while something reads the usage, when sampling starts again wait for the first rates"
+        if needed:
+            if not self.sampler.active.is_set():
+                self.sampler.resume()
+                self.warm()
+        else:
+            self.sampler.pause()
+
+    def stat(self, name, window, stat, whole=None):
+        "Sampler stat over window, or over the default window which may not be full yet right after startup"
+        return self.sampler.stat(name, window or self.window, stat, whole, partial=not window)
+
+    def counter(self, name, foreign=None):
+        "Return the name of the counter to use for name"
+        if self.foreign if foreign is None else foreign:
+            if self.sampler.has('foreign:' + name):
+                return 'foreign:' + name
+        return name
+
+    def get_net(self, window=None, target=None, stat='avg', foreign=None):   # pylint: disable=unused-argument
+        '''Network usage on the interfaces matching target or the default interfaces
+        Network usage can't be split by process, so foreign is accepted but makes no difference'''
+        pattern = target or self.interfaces
+        if pattern not in self.netglobs:
+            # Counted from the next sample on
+            self.netglobs[pattern] = ({}, 0)
+            return None
+        return self.stat('netglob:' + pattern, window, stat)
+
+    def get_disk(self, window=None, target=None, stat='avg', foreign=None):
+        '''Disk usage for all disks, or just the disks behind a device name or path
+        Our own usage can't be split by disk, so foreign only applies to all disks'''
+        if target:
+            disks = self.disks(target)
+            if disks:
+                rates = [self.stat('disk:' + disk, window, stat) for disk in disks]
+                return None if None in rates else sum(rates)
+        return self.stat(self.counter('disk', foreign), window, stat)
+
+    def get_cpu(self, window=None, stat='avg', foreign=None):
+        return self.stat(self.counter('cpu_busy', foreign), window, stat, whole='cpu_total')
+
+    def get_pressure(self, kind, window=None, stat='avg'):
+        "Percent of the time some tasks were stalled waiting for cpu, io or memory"
+        val = self.stat('pressure:' + kind, window, stat)
+        return None if val is None else val / 1e4
+
+    def get_cpu_pressure(self, window=None, stat='avg'):
+        return self.get_pressure('cpu', window, stat)
+
+    def get_io_pressure(self, window=None, stat='avg'):
+        return self.get_pressure('io', window, stat)
+
+    def get_mem_pressure(self, window=None, stat='avg'):
+        return self.get_pressure('memory', window, stat)
+
+    def get_mem(self, window=None, stat='last'):
+        "Bytes of memory available, the lowest is the worst so over and percentiles are flipped"
+        stat = dict(max='min').get(stat, stat)
+        if stat.startswith('p'):
+            stat = 'p' + str(100 - float(stat[1:]))
+        return self.sampler.level('mem', window or self.window, stat, partial=not window)
+
+    def get_swap(self, window=None, stat='last'):
+        return self.sampler.level('swap', window or self.window, stat, partial=not window)
+
+    def get_load(self, window=None, stat='last'):
+        "5 minute load average per cpu core"
+        return self.sampler.level('load', window or self.window, stat, partial=not window)
+
+    def has_pressure(self,):
+        return self.sampler.has('pressure:io')
+
+    def disks(self, target):
+        "Return the disks with counters behind target, checked again every minute in case of new mounts"
+        now = time.time()
+        if target not in self.targets or now - self.targets[target][0] > 60:
+            try:
+                disks = [disk for disk in devices.block_devices(target) if self.sampler.has('disk:' + disk)]
+            except OSError:
+                disks = []
+            if not disks and target not in self.targets:
+                warn("Could not find the disk for", target, "using all disks instead.")
+            self.targets[target] = (now, disks)
+        return self.targets[target][1]
 
 
-    def _query(self, vals, cmd, *args, **kargs):
-        "Return a value if available, otherwise start a thread and return None while we wait"
-        now = time.time()
-        if now - vals.timestamp <= self.expiration:
-            # print("Found existing value", vals.value)
-            return vals.value
-        else:
-            if not vals.thread:
-                # Start a thread
-                # print("Spawning thread to check value")
-                vals.que, vals.thread = spawn(cmd, *args, **kargs)
-                return None
-            else:
-                # Check existing thread to see if it's done
-                if vals.thread.is_alive():
-                    # print("Thread still running")
-                    return None
-                else:
-                    vals.thread = None
-                    vals.value = vals.que.get()
-                    # print("Value ready:", vals.value)
-                    vals.timestamp = now
-                    return vals.value
+def match_interface(name, pattern):
+    "Does the interface name match a pattern like: wlan* eth0 !tun*"
+    words = pattern.split()
+    include = [word for word in words if not word.startswith('!')] or ['*']
+    exclude = [word[1:] for word in words if word.startswith('!')]
+    return any(fnmatch.fnmatch(name, word) for word in include) and \
+        not any(fnmatch.fnmatch(name, word) for word in exclude)
 
 
 def is_busy(busy,):
@@ -142,8 +292,7 @@ def is_busy(busy,):
     def fmt(num):
         return rfs(num)+'/s'
 
-    # Values are cached by Busy class.
-    # Requesting them spins up a thread to check their values, but returns None if not ready yet.
+    # Values are sampled in the background by the Busy class and None until the first two samples are in.
     net_usage = busy.get_net()
     disk_usage = busy.get_disk()
     cpu_usage = busy.get_cpu()
@@ -157,15 +306,23 @@ def is_busy(busy,):
         aprint("Busy: Network Usage:", fmt(net_usage))
         return True
 
-    # Disk Usage
-    if disk_usage >= shared.LOW_DISK:
-        aprint("Busy: Disk usage:", fmt(disk_usage))
-        return True
+    if UA.pressure and busy.has_pressure():
+        # Stalls show real contention better than throughput, so they replace the disk and cpu checks
+        for kind in ('cpu', 'io', 'memory'):
+            pressure = busy.get_pressure(kind, window=60)
+            if pressure is not None and pressure >= UA.pressure:
+                aprint("Busy:", kind.title(), "pressure:", sig(pressure, 2) + '%')
+                return True
+    else:
+        # Disk Usage
+        if disk_usage >= shared.LOW_DISK:
+            aprint("Busy: Disk usage:", fmt(disk_usage))
+            return True
 
-    # Cpu usage
-    if cpu_usage >= shared.LOW_CPU:
-        aprint("Busy: Cpu Usage:", sig(3.14*10, 2) + '%')
-        return True
+        # Cpu usage
+        if cpu_usage >= shared.LOW_CPU:
+            aprint("Busy: Cpu Usage:", sig(cpu_usage, 2) + '%')
+            return True
 
     aprint("Not Busy - Network Usage:", fmt(net_usage), "Disk usage:", fmt(disk_usage))
     return False
@@ -180,24 +337,84 @@ def is_idle(twatch,):
     return False
 
 
+def idle_deadline(twatch,):
+    "Earliest time that is_idle could return True"
+    limits = [limit for limit in (UA.idle, UA.idlebatt) if limit]
+    if not limits:
+        return float('inf')
+    # Idle time can't grow faster than the clock
+    remaining = min(limits) - twatch.idle
+    return time.time() + max(remaining, UA.polling)
+
+
+# Whitespace runs that can split a line: 2+ whitespace characters or a single tab
+SPLITTERS = re.compile(r"\s{2,}|\t")
+
+
+def split_run(run, offset, spaces):
+    '''Return the (start, end) separators found in a whitespace run containing tabs
+    Same result as re.split(r"\t+|\s{spaces,}") would give on this run'''
+    seps = []
+    pos = 0
+    length = len(run)
+    while pos < length:
+        if run[pos] == '\t':
+            end = pos + 1
+            while end < length and run[end] == '\t':
+                end += 1
+            seps.append((offset + pos, offset + end))
+            pos = end
+        elif length - pos >= spaces:
+            seps.append((offset + pos, offset + length))
+            break
+        else:
+            pos += 1
+    return seps
+
+
 def read_line(line, warn_score=5):
     "Given a line delimited by tabs and spaces, convert it to 5 fields"
 
+    # Find the whitespace runs once
+    runs = [(match.start(), match.end(), match.group()) for match in SPLITTERS.finditer(line)]
+
     candidates = []
+    last = None
     # Start with a large number of spaces (or any tabs) and reduce until the line is parsed
     for spaces in range(8, 1, -1):
-        cols = re.split(r"\t+|\s{" + str(spaces) + ",}", line)
-        # cols = re.split(r"\s{" + str(spaces) + ",}", line)
-        cols = [item.strip() for item in cols if item]
-        if len(cols) < 5:
+        seps = []
+        for start, end, run in runs:
+            if '\t' in run:
+                seps.extend(split_run(run, start, spaces))
+            elif end - start >= spaces:
+                seps.append((start, end))
+
+        # Reuse the previous candidate if the separators didn't change
+        if last and seps == last[0]:
+            if last[1]:
+                candidates.append(last[1])
             continue
 
-        # Score each candidate based on spaces and tabs
-        score = 10 - (len(cols) - 5) * 2        # 2 points off per extra field
-        for item in cols[:4]:
-            score -= item.count('  ') * 3       # double spaces inside field
-            score -= item.count('\t') * 6       # tabs inside field
-        candidates.append([score, cols])
+        # Text between separators
+        cols = []
+        pos = 0
+        for start, end in seps:
+            if start > pos:
+                cols.append(line[pos:start].strip())
+            pos = end
+        if pos < len(line):
+            cols.append(line[pos:].strip())
+
+        candidate = None
+        if len(cols) >= 5:
+            # Score each candidate based on spaces and tabs
+            score = 10 - (len(cols) - 5) * 2        # 2 points off per extra field
+            for item in cols[:4]:
+                score -= item.count('  ') * 3       # double spaces inside field
+                score -= item.count('\t') * 6       # tabs inside field
+            candidate = [score, cols]
+            candidates.append(candidate)
+        last = seps, candidate
 
     if not candidates:
         return False
@@ -302,6 +519,11 @@ class Debugger:
             if match:
                 match.reqs.print()
 
+        elif first == 'runs':
+            match = self.find_app(tail)
+            if match:
+                match.show_runs()
+
         elif first == 'print':
             # Print the app given after app
             match = self.find_app(tail)
@@ -316,6 +538,12 @@ class Debugger:
         elif cmd == 'args':
             print(UA)
 
+        elif cmd == 'profile':
+            if PROFILE.enabled:
+                PROFILE.report()
+            else:
+                print("Start with --profile to use the profiler")
+
         # Changing verbose requires special handling
         elif first == 'verbose':
             try:
@@ -371,7 +599,7 @@ def go2sleep(twatch):
 class ScriptManager:
     "Keep track of all the available scripts and when last run"
 
-    def __init__(self, busy, twatch, file):
+    def __init__(self, busy, twatch, file, journal=None, cache=None, watcher=None):
         self.schedule_apps = []                     # Apps found in schedule.txt
         self.schedule_file = file                   # Schedule File Name
         self.last_schedule_read = 0                 # Last time the schedule file was read
@@ -379,6 +607,12 @@ class ScriptManager:
         self.busy = busy
         self.twatch = twatch
         self.alert = msgbox                         # Set function to send alerts
+        self.queue = DeadlineQueue()                # Next time each app could be ready
+        self.order = {}                             # App id to line number in schedule
+        self.table = None                           # Vectorized gates for large schedules
+        self.journal = journal                      # Saves app history between restarts
+        self.cache = cache                          # Parsed schedule lines from last time
+        self.watcher = watcher                      # Notices changes to the schedule file
 
         self.sleep_procs = []                       # List of procs ran on suspend
         self.sleep_check = 0                        # Last time sleepy_time was called
@@ -386,7 +620,17 @@ class ScriptManager:
 
     def update(self,):
         "Check schedule file and update if new"
-        if os.path.getmtime(self.schedule_file) > self.last_schedule_read:
+        if self.watcher:
+            if not self.watcher.check():
+                return
+            if not os.path.exists(self.schedule_file):
+                aprint("Schedule file missing:", self.schedule_file)
+                return
+            changed = True
+        else:
+            changed = os.path.getmtime(self.schedule_file) > self.last_schedule_read
+
+        if changed:
             if self.last_schedule_read:
                 aprint("Schedule file updated:", '\n' + '#' * 80)
             else:
@@ -394,6 +638,14 @@ class ScriptManager:
                 print("\n\nSchedule file:", '\n' + '#' * 80)
             self.last_schedule_read = time.time()
             self.read_schedule()
+            self.busy.sampling(self.uses_usage())
+
+
+    def uses_usage(self,):
+        "Does anything read the system usage? Suspending checks it first and metrics report it"
+        if UA.idle or UA.idlebatt or UA.metrics:
+            return True
+        return any(name in proc.reqs.reqs for proc in self.schedule_apps for name in scheduler.Reqs.usage_reqs)
 
 
     def sleepy_time(self, polling_rate):
@@ -438,106 +690,241 @@ class ScriptManager:
             return False
 
 
+    def next_deadline(self,):
+        "Earliest time any app could be ready to run"
+        return self.queue.next_deadline()
+
+
     def run_scripts(self, polling_rate, flag=None):
-        "Attempt to run all of the scripts in schedule"
+        '''Attempt to run the scripts in schedule
+        Normally only the apps with a passed deadline are checked, flags check them all'''
+
+        if flag:
+            procs = list(self.schedule_apps)
+        else:
+            procs = self.queue.pop_due(time.time())
+            procs.sort(key=lambda proc: self.order.get(id(proc), 0))
+
+        # Filter out apps that can't be ready in one pass (detailed alerts are skipped)
+        if self.table and shared.VERBOSE < 3:
+            procs, failed = self.table.survivors(procs, self.twatch, time.time(), flag=flag)
+            for proc in failed:
+                self.push(proc, polling_rate)
 
         started = []
-        for proc in self.schedule_apps:
+        for index, proc in enumerate(procs):
             if UA.stagger and (time.time() - self.last_run) / 60 < UA.stagger:
+                # Check the rest after the stagger time is up
+                for proc in procs[index:]:
+                    self.queue.push(proc, self.last_run + UA.stagger * 60)
                 break
 
             if proc.ready(self.twatch) and proc.check_reqs(self.twatch, polling_rate, self.busy, flag=flag):
-
+                runs = len(proc.history)
                 if UA.skip and time.time() - shared.START_TIME < UA.skip * 60 and 'start' not in proc.reqs.reqs:
                     result = proc.run(self.twatch, testing_mode=UA.testing, skip_mode=True,)
                 else:
                     result = proc.run(self.twatch, testing_mode=UA.testing, skip_mode=False,)
 
+                if self.journal:
+                    self.journal.record_app(proc, len(proc.history) > runs)
                 if result:
                     started.append(proc)
                     self.last_run = time.time()
+            self.push(proc, polling_rate)
+
+        if self.journal:
+            self.journal.flush()
         return started
 
 
+    def push(self, proc, polling_rate):
+        "Update the deadline and table row for an app after checking it"
+        self.queue.push(proc, proc.next_eligible(self.twatch, polling_rate))
+        if self.table:
+            self.table.update(proc)
+
+
 
 
     def read_schedule(self,):
-        "Read the schedule file"
+        '''Read the schedule file
+        Lines are matched to the existing Apps by hash so unchanged lines keep their App,
+        edited lines with the same command keep the history of the App they replace.'''
 
         new_sched = []
+        created = []                                # New Apps in this generation
         headers = "time frequency date reqs path".split()
 
+        # Previous generation by line hash
+        old = dict()
+        for proc in self.schedule_apps:
+            old.setdefault(proc.key, []).append(proc)
+
         with open(self.schedule_file) as f:
-            for line in f.readlines():
-                # Ignore comments and empty lines
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
+            text = f.read()
+
+        # Skip the comments and tokenizer if the schedule file is unchanged since last time
+        lines = self.cache.get_lines(text) if self.cache else None
+        if lines is None:
+            # Ignore comments and empty lines
+            lines = [line.strip() for line in text.splitlines()]
+            lines = [line for line in lines if line and not line.startswith('#')]
+
+        for raw in lines:
+            cached = self.cache.get(raw) if self.cache else None
+            if cached:
+                line, definition = dict(cached[0]), cached[1]
+            else:
+                definition = None
 
                 # Find lines that have 5 fields in them
-                cols = read_line(line)
+                cols = read_line(raw)
                 if not cols:
-                    self.alert("Can't process line:", repr(line), "\nMake sure you put tabs in between columns")
+                    self.alert("Can't process line:", repr(raw), "\nMake sure you put tabs in between columns")
                     continue
                 line = dict(zip(headers, cols))
 
+                # Slip in command line reqs:
+                if UA.reqs:
+                    reqs = line['reqs'].strip()
+                    if reqs == '*':
+                        reqs = UA.reqs.strip()
+                    else:
+                        if reqs and not reqs.endswith(','):
+                            reqs += ', '
+                        reqs += UA.reqs.strip()
+                    line['reqs'] = reqs
+
+            # See if it matches an existing App
+            matches = old.get(scheduler.line_key(line))
+            if matches:
+                new_sched.append(matches.pop(0))
+                continue
 
-                # See if it matches an existing App
-                for proc in self.schedule_apps:
-                    if line == proc.args:
-                        print("Using existing App definition:", proc.name)
-                        new_sched.append(proc)
-                        break
+            # Otherwise try to create a new one
+            # Show the args used to creat proc
+            auto_cols([[item.title()+':' for item in headers], [repr(item) for item in line.values()], []])
 
-                # Otherwise try to create a new one
-                else:
-                    # Show the args used to creat proc
-                    auto_cols([[item.title()+':' for item in headers], [repr(item) for item in cols], []])
-
-                    # Slip in command line reqs:
-                    if UA.reqs:
-                        reqs = line['reqs'].strip()
-                        if reqs == '*':
-                            reqs = UA.reqs.strip()
-                        else:
-                            if reqs and not reqs.endswith(','):
-                                reqs += ', '
-                            reqs += UA.reqs.strip()
-                            print(reqs)
-                            line['reqs'] = reqs
-
-                    # Try to process each line
-                    try:
-                        proc = scheduler.App(line)
-
-                    # Bare exception to cover any processing errors
-                    except Exception as e:      # pylint: disable=broad-except
-                        self.alert("Could not process line:", line)
-                        traceback.print_exc()
-                        print(e, '\n\n\n')
-                        continue
-                        # proc.add_reqs(UA.reqs)
-                    proc.print()
-                    print('\n'*2)
-
-                    if proc.cmd:
-                        new_sched.append(proc)
+            # Try to process each line
+            try:
+                proc = scheduler.App(line, definition)
+
+            # Bare exception to cover any processing errors
+            except Exception as e:      # pylint: disable=broad-except
+                self.alert("Could not process line:", line)
+                traceback.print_exc()
+                print(e, '\n\n\n')
+                continue
+            if self.journal and self.journal.restore_app(proc):
+                print("Restored history from previous session:", len(proc.history), "runs")
+            proc.print()
+            print('\n'*2)
+
+            if proc.cmd:
+                new_sched.append(proc)
+                created.append(proc)
+                if self.cache and not definition:
+                    self.cache.put(raw, proc)
+
+        if self.cache:
+            self.cache.save(text, lines)
+
+        if not new_sched:
+            return
+
+        # Edited lines with the same command carry on from the old App
+        edited = dict()
+        for procs in old.values():
+            for proc in procs:
+                edited.setdefault(proc.args['path'], []).append(proc)
+        for proc in created:
+            if edited.get(proc.args['path']):
+                parent = edited[proc.args['path']].pop(0)
+                proc.inherit(parent)
+                if self.journal:
+                    self.journal.record_inherit(proc, parent)
+                print("Kept history of edited line:", proc.name)
+        if self.journal:
+            self.journal.flush()
+
+        reused = len(new_sched) - len(created)
+        if reused:
+            print("Using", reused, "existing App definitions")
+
+        # Only the new apps need to be checked right away
+        for procs in old.values():
+            for proc in procs:
+                self.queue.discard(proc)
+        for proc in created:
+            self.queue.push(proc, 0)
 
         # Modify in place
-        if new_sched:
-            self.schedule_apps[:] = new_sched
+        self.schedule_apps[:] = new_sched
+        self.order = {id(proc): num for num, proc in enumerate(new_sched)}
+        self.table = app_table.AppTable(new_sched) if app_table.available(len(new_sched)) else None
+
+
+def update_metrics(sman, busy, twatch, tick_start):
+    "Set the gauges that are read once per loop"
+    METRICS.observe('lazycron_tick_seconds', time.perf_counter() - tick_start)
+    now = time.time()
+    states = dict(running=0, due=0, scheduled=0, inactive=0)
+    for proc in sman.schedule_apps:
+        deadline = sman.queue.deadline(proc)
+        if proc.running():
+            states['running'] += 1
+        elif deadline <= now:
+            states['due'] += 1
+        elif deadline < float('inf'):
+            states['scheduled'] += 1
+        else:
+            states['inactive'] += 1
+    for state, count in states.items():
+        METRICS.set('lazycron_apps', count, state=state)
+
+    waiting = len(SUPERVISOR.slots.waiting)
+    METRICS.set('lazycron_jobs_running', max(SUPERVISOR.jobs - waiting, 0))
+    METRICS.set('lazycron_jobs_waiting', waiting)
+
+    for name, func in (('cpu', busy.get_cpu), ('disk', busy.get_disk), ('network', busy.get_net),
+                       ('mem', busy.get_mem), ('load', busy.get_load)):
+        val = func()
+        if val is not None:
+            METRICS.set('lazycron_usage', val, resource=name)
+
+    METRICS.set('lazycron_twatch_seconds', twatch.idle, counter='idle')
+    METRICS.set('lazycron_twatch_seconds', twatch.elapsed, counter='elapsed')
+    METRICS.set('lazycron_twatch_seconds', twatch.today_elapsed, counter='today_elapsed')
+    METRICS.set('lazycron_twatch_seconds', twatch.usage(), counter='usage')
 
 
 def main(verbose=1):
-    polling_rate = 0                        # Time to rest at the end of every loop
-    twatch = timewatch.TimeWatch(verbose=verbose)
+    polling_rate = 0                        # How often to recheck apps waiting on changing reqs
+    sleep_time = 0                          # Time to rest at the end of every loop
+    twatch = timewatch.TimeWatch(verbose=verbose, step=UA.polling)
 
     cur_day = time.localtime().tm_yday      # Used for checking for new day
     sleep_failed = 0                        # Number of times Sleep command failed.
     just_slept = False                      # Just woke up from sleep
 
-    busy = Busy(expiration=max(UA.polling * 2.5, 60))
-    sman = ScriptManager(busy, twatch, UA.schedule)     # Script Manager
+    if UA.profile:
+        PROFILE.enable()
+        last_report = time.monotonic()
+    busy = Busy(foreign=UA.foreign, interfaces=UA.interfaces, interval=UA.sample)
+    SUPERVISOR.slots.configure(UA.budgets)
+    journal = Journal(UA.state) if UA.state else None
+    if UA.state:
+        SUPERVISOR.rundb = rundb.RunDB(UA.state)
+    if journal:
+        journal.restore_twatch(twatch)
+    cache = ScheduleCache(UA.state, extra=UA.reqs) if UA.state else None
+    watcher = FileWatcher(UA.schedule, wake=twatch.wake, interval=UA.polling)
+    sman = ScriptManager(busy, twatch, UA.schedule, journal, cache, watcher)     # Script Manager
+    # Have usage rates ready before the first check
+    if not busy.warm():
+        warn("System usage counters are not available")
+    metrics = MetricsOutput(UA.metrics) if UA.metrics else None
 
 
     if UA.debug:
@@ -548,13 +935,16 @@ def main(verbose=1):
             sman.alert = warn
 
         # Sleep at the end of every loop
-        missing = twatch.sleep(polling_rate)
-        # Loop again to avoid edge case where the machine wakes up and is immediately put back to sleep
-        while missing > 2 and missing > polling_rate / 10:
-            if not just_slept:
-                just_slept = True
-            missing = twatch.sleep(polling_rate)
+        with PROFILE.phase('sleep'):
+            missing = twatch.sleep(sleep_time)
+            # Loop again to avoid edge case where the machine wakes up and is immediately put back to sleep
+            while missing > 2 and missing > sleep_time / 10:
+                if not just_slept:
+                    just_slept = True
+                sleep_time = UA.polling
+                missing = twatch.sleep(sleep_time)
         polling_rate = UA.polling
+        tick_start = time.perf_counter()
 
         # Check for a new day
         if time.localtime().tm_yday != cur_day:
@@ -566,29 +956,66 @@ def main(verbose=1):
 
 
         if just_slept:
-            sman.run_scripts(polling_rate, flag='wake')
+            with PROFILE.phase('run_scripts'):
+                sman.run_scripts(polling_rate, flag='wake')
             just_slept = False
 
 
-        sman.update()                       # Update schedule file if it's been updated
-        sman.run_scripts(polling_rate)      # Run the scripts
+        with PROFILE.phase('update'):
+            sman.update()                   # Update schedule file if it's been updated
+        if journal:
+            journal.record_twatch(twatch)
+        with PROFILE.phase('run_scripts'):
+            sman.run_scripts(polling_rate)  # Run the scripts
 
         # Give up after sleep command fails too much, (messes up time calculations)
         if sleep_failed <= 3:
             # Put the computer to sleep after checking to make sure nothing is going on.
-            if is_idle(twatch) and not is_busy(busy):
+            with PROFILE.phase('is_busy'):
+                ready = is_idle(twatch) and not is_busy(busy)
+            if ready:
                 # Run any sleep scripts:
                 if sman.sleepy_time(polling_rate) and go2sleep(twatch):
-                    polling_rate = 2
+                    sleep_time = 2
                     just_slept = True
+                    if metrics:
+                        update_metrics(sman, busy, twatch, tick_start)
+                        metrics.write()
+                    continue
                 else:
                     sleep_failed += 1
 
+        # Sleep until the next app could be ready, the suspend check or a new day
+        now = time.time()
+        wakeup = min(sman.next_deadline(),
+                     now + 86400 - seconds_since_midnight(),
+                     now + UA.maxsleep,
+                     )
+        if sleep_failed <= 3:
+            wakeup = min(wakeup, idle_deadline(twatch))
+        if sman.sleep_procs:
+            wakeup = min(wakeup, now + polling_rate)
+        sleep_time = max(wakeup - now, 1)
+        aprint("Sleeping for", fmt_time(sleep_time), v=4)
+
+        if metrics:
+            update_metrics(sman, busy, twatch, tick_start)
+            metrics.write()
+
+        PROFILE.tick()
+        if UA.profile and time.monotonic() - last_report >= UA.profile * 60:
+            PROFILE.report()
+            last_report = time.monotonic()
+
 
 
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['stats']:
+        del sys.argv[1]
+        rundb.main()
+        sys.exit(0)
     UA = parse_args()
     timewatch.verify()
     # Min level to print messages:
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# Columns of App values so the simple gates can be checked for thousands of apps at once
+# Requires numpy, otherwise every app falls through to App.ready() and App.check_reqs()
+
+import importlib
+
+if importlib.util.find_spec("numpy"):
+    import numpy as np
+else:
+    np = None
+
+
+MIN_APPS = 64           # Below this many apps, plain python is faster than building arrays
+
+# Column names. Missing values are stored as 0 or inf so their comparisons always pass
+COLUMNS = ('start',         # App.start (0 if no time window)
+           'stop',          # App.stop
+           'next_run',      # App.next_run
+           'elapsed_next',  # App.elapsed_next (0 if no elapsed frequency)
+           'runs',          # len(App.history)
+           'session_runs',  # App.session_runs()
+           'reps',          # Runs in the current window (App.count_reps)
+           'max_start',     # reqs.start
+           'max_runs',      # reqs.max
+           'max_reps',      # reqs.reps
+           'idle',          # reqs.idle
+           'busy',          # reqs.busy
+           'elapsed',       # reqs.elapsed
+           'today',         # reqs.today
+           'flag',          # 1 = wake only, 2 = suspend only
+           )
+
+
+def available(count):
+    "Is it worth using an AppTable for count apps?"
+    return np is not None and count >= MIN_APPS
+
+
+class AppTable:
+    '''Mirror of the App values needed for the time, frequency, elapsed and reps gates.
+    Stale rows are harmless: every value only grows between updates, so a stale row will
+    only let an app through to the full per object check.'''
+
+    def __init__(self, apps):
+        self.apps = list(apps)
+        self.rows = {id(app): num for num, app in enumerate(self.apps)}
+        self.cols = {name: np.zeros(len(self.apps)) for name in COLUMNS}
+        for app in self.apps:
+            self.update(app)
+
+
+    def update(self, app):
+        "Copy the current state of an app into its row"
+        row = self.rows.get(id(app))
+        if row is None:
+            return
+        inf = float('inf')
+        cols = self.cols
+        reqs = app.reqs.reqs
+
+        windowed = app.window or app.date_window
+        cols['start'][row] = app.start if windowed else 0
+        cols['stop'][row] = app.stop if windowed else inf
+        cols['next_run'][row] = app.next_run
+        cols['elapsed_next'][row] = app.elapsed_next if app.elapsed_freq else 0
+        cols['runs'][row] = len(app.history)
+        cols['session_runs'][row] = app.session_runs()
+        cols['reps'][row] = app.count_reps()[0] if 'reps' in reqs else 0
+
+        cols['max_start'][row] = reqs.start if 'start' in reqs else inf
+        cols['max_runs'][row] = reqs.max if 'max' in reqs else inf
+        cols['max_reps'][row] = reqs.reps if 'reps' in reqs else inf
+        for name in ('idle', 'busy', 'elapsed', 'today'):
+            cols[name][row] = reqs[name] if name in reqs else 0
+        cols['flag'][row] = 1 if 'wake' in reqs else 2 if 'suspend' in reqs else 0
+
+
+    def mask(self, twatch, now, flag=None):
+        "Boolean array of apps that pass all of the simple gates"
+        cols = self.cols
+        # Time window. Apps past their stop time must recalculate, so let them through
+        ok = (cols['start'] <= now) | (cols['stop'] < now)
+        # Frequency
+        ok &= cols['next_run'] <= now
+        ok &= cols['elapsed_next'] <= twatch.elapsed
+        # History
+        ok &= cols['session_runs'] < cols['max_start']
+        ok &= cols['runs'] < cols['max_runs']
+        ok &= (cols['reps'] < cols['max_reps']) | (cols['stop'] < now)       # Reps reset in a new window
+        # Usage
+        ok &= cols['idle'] <= twatch.idle
+        ok &= cols['busy'] <= twatch.usage()
+        ok &= cols['elapsed'] <= twatch.elapsed
+        ok &= cols['today'] <= twatch.today_elapsed
+        # Special flags
+        code = {'wake': 1, 'suspend': 2}.get(flag, 0)
+        ok &= (cols['flag'] == 0) | (cols['flag'] == code)
+        return ok
+
+
+    def survivors(self, apps, twatch, now, flag=None):
+        '''Split apps into a list that could be ready and a list that definitely isn't
+        Apps not in the table are always survivors'''
+        ok = self.mask(twatch, now, flag)
+        passed = []
+        failed = []
+        for app in apps:
+            row = self.rows.get(id(app))
+            if row is None or ok[row]:
+                passed.append(app)
+            else:
+                failed.append(app)
+        return passed, failed
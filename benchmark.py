@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+# Measure how the schedule parser and scheduler scale with the number of lines
+# Usage: ./benchmark.py --sizes 10,1000,100000 > bench.json
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tracemalloc
+import contextlib
+import tempfile
+import subprocess
+
+from sd.easy_args import easy_parse
+from sd.common import DotDict, qwarn
+
+# Keep stdout clean for the json output
+with contextlib.redirect_stdout(sys.stderr):
+    import shared
+    import timewatch
+    import scheduler
+    import LazyCron
+    from schedule_cache import ScheduleCache
+
+
+# Pieces of the schedule grammar, modeled after test.schedule.txt
+TIMES = ('*', '*', '1-3am', '2pm-4pm', '11pm-2am', '-5pm', '1-3am, 2pm - 4pm', '12am to 11:59pm',
+         '9-11pm', '11:30-11:34', '8:30pm-3am')
+FREQS = ('*', '*', '0', '1h', '30m', '7d', '4s elapsed', '2h elapsed', '1h, 30m elapsed')
+DATES = ('*', '*', '*', 'sat-sun', 'm-f', '2nd Thursday', 'March 14', '1st-2nd', 'Oct-Feb', 'Thursday-Mon')
+REQS = ('idle 5m', 'busy 10', 'elapsed 8s', 'today 8s', 'random 60s', 'start', 'skip', 'reps 2', 'max 2',
+        'delay 4s', 'loop 2', 'retry', 'loopdelay 4s', 'delaymult 1.2', 'timeout 10s', 'nice 10', 'online',
+        'plugged', 'unplugged', 'closed', 'open', 'lowbatt 20', 'minbatt 50', 'cpu 10', 'disk 1M',
+        'network 10K', "ssid: 'free wifi'", "environs 'muffins = 3 $ test = 2'", 'nologs', 'noerrs',
+        'wake', 'suspend')
+SEPARATORS = ('\t', '\t\t', '    ', '        ', '\t  ')
+
+
+def gen_schedule(lines, seed=0):
+    "Generate a random schedule with lines covering the whole grammar"
+    rand = random.Random(seed)
+    out = ['# Generated schedule with ' + str(lines) + ' lines', '']
+    for num in range(lines):
+        reqs = '*'
+        if rand.random() > 0.2:
+            reqs = ', '.join(rand.sample(REQS, rand.randint(1, 3)))
+        cols = [rand.choice(TIMES), rand.choice(FREQS), rand.choice(DATES), reqs]
+        line = ''.join(col + rand.choice(SEPARATORS) for col in cols)
+        # Mostly testing paths, (no PATH lookup) with a few real ones
+        if num % 10:
+            line += '# job ' + str(num)
+        else:
+            line += 'echo job ' + str(num)
+        out.append(line)
+    return '\n'.join(out) + '\n'
+
+
+# Lines that are hard to split, mixing tabs and spaces of different lengths
+AMBIGUOUS = ('*  0  *  *  # two spaces',
+             '*   0   *   *   # three spaces',
+             '*\t0 *\t*\t# missing tab',
+             '* \t0\t \t* \t * \t# spaces around tabs',
+             '*\t\t\t0\t\t*\t*\t\t# many tabs',
+             '1-3am,  2pm-4pm    1h    *    idle 5    echo  two  spaces',
+             '2pm - 4pm        *        sat-sun        online, idle 5       msgbox "a  b"',
+             '*                  7d   *    open, busy 1       \tmsgbox "tab at end"',
+             '* \t \t0    *  \t  *        # spaces between tabs',
+             '*  \t  0\t   *\t    *\t     # more spaces between tabs',
+             '*\t0\t*\t*\techo\ta\tb\tc',
+             '*  0  *  *  echo  a  b',
+             '*      0       *       *       echo    a    b',
+             '*\x0b\x0b0\x0c\x0c*\r\r*\xa0\xa0# other whitespace',
+             '*        0       *      *     echo',
+             '* 0 * * # too few',
+             '*\t0\t*\t# four fields',
+             )
+
+
+def reference_read_line(line, warn_score=5):
+    "The original regex version of LazyCron.read_line used to verify the current one"
+
+    candidates = []
+    # Start with a large number of spaces (or any tabs) and reduce until the line is parsed
+    for spaces in range(8, 1, -1):
+        cols = re.split(r"\t+|\s{" + str(spaces) + ",}", line)
+        cols = [item.strip() for item in cols if item]
+        if len(cols) < 5:
+            continue
+
+        # Score each candidate based on spaces and tabs
+        score = 10 - (len(cols) - 5) * 2        # 2 points off per extra field
+        for item in cols[:4]:
+            score -= item.count('  ') * 3       # double spaces inside field
+            score -= item.count('\t') * 6       # tabs inside field
+        candidates.append([score, cols])
+
+    if not candidates:
+        return False
+
+    def print_can():
+        for score, can in candidates:
+            print(str(score) + ':', can)
+
+    # Return the best scoring candidate
+    candidates.sort()
+    if shared.VERBOSE >= 3:
+        print_can()
+    score, cols = candidates[-1]
+
+    # Bump up a low score if path is valid
+    if score <= warn_score:
+        path = cols[4].lstrip('#').strip().split()[:1]
+        print("path =", path)
+        if path and shutil.which(path[0]):
+            score += 5
+
+    if score <= warn_score:
+        print_can()
+        LazyCron.warn("Did I read this line correctly?")
+        print('Source    :', repr(line))
+        print('Conversion:', cols)
+        print("Try using tabs instead of spaces if wrong")
+
+    # If excess fields, combine the rest of the fields after 5 and return
+    if len(cols) == 5:
+        return cols
+    else:
+        path = line[line.index(cols[4]):]
+        return cols[:4] + [path]
+
+
+def corpus(fuzz=2000, seed=0):
+    "Schedule lines to check read_line with"
+    lines = list(AMBIGUOUS)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in ('schedule.txt', 'test.schedule.txt'):
+        with open(os.path.join(folder, name)) as f:
+            lines += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    lines += gen_schedule(200).splitlines()[2:]
+
+    # Random words joined by random whitespace
+    rand = random.Random(seed)
+    for _num in range(fuzz):
+        words = rand.choices(('*', '0', '1h', 'sat-sun', 'idle 5', 'echo', '#', 'a'), k=rand.randint(3, 9))
+        line = words[0]
+        for word in words[1:]:
+            line += ''.join(rand.choices(' \t', weights=(4, 1), k=rand.randint(1, 9))) + word
+        lines.append(line)
+    return lines
+
+
+def verify(verbose=(1, 3)):
+    "Check that read_line gives the same results and messages as the original, return number of mismatches"
+    errors = 0
+    for level in verbose:
+        shared.VERBOSE = level
+        for line in corpus():
+            out = []
+            for func in (reference_read_line, LazyCron.read_line):
+                text = io.StringIO()
+                with contextlib.redirect_stdout(text), contextlib.redirect_stderr(io.StringIO()):
+                    result = func(line)
+                out.append((result, text.getvalue()))
+            if out[0] != out[1]:
+                errors += 1
+                print("Mismatch for line:", repr(line), file=sys.stderr)
+                print(out[0], '\n', out[1], file=sys.stderr)
+    shared.VERBOSE = 0
+    return errors
+
+
+class FakeComputer:
+    "Stand in for computer.Computer with fixed values"
+    def lid_open(self,):
+        return True
+
+    def plugged_in(self,):
+        return True
+
+    def get_charge(self,):
+        return 50
+
+    def get_ssid(self,):
+        return 'free wifi'
+
+
+class FakeBusy:
+    "Stand in for the how_busy modules that returns instantly"
+    @staticmethod
+    def get_cpu_usage(*_args, **_kargs):
+        return 1
+
+    @staticmethod
+    def get_network_usage(*_args, **_kargs):
+        return 1e3
+
+    @staticmethod
+    def all_disk_usage(*_args, **_kargs):
+        return 1e5
+
+    @staticmethod
+    def counters():
+        "Counters that grow at the same rates as above"
+        now = time.monotonic()
+        return dict(cpu_busy=now, cpu_total=now * 100, disk=now * 1e5, net=now * 1e3)
+
+
+def stub():
+    "Replace everything that touches the real system"
+    shared.COMP = FakeComputer()
+    shared.VERBOSE = 0
+    LazyCron.how_busy = FakeBusy
+    timewatch.get_idle = lambda: 3600
+    scheduler.get_idle = lambda: 3600
+    scheduler.check_internet = lambda: True
+    scheduler.msgbox = lambda *args, **kargs: None
+    LazyCron.warn = qwarn                   # Without the delay
+    LazyCron.UA = DotDict(reqs=None, stagger=0, skip=0, testing=True, polling=60)
+
+
+def quiet():
+    "Hide the output of the scheduler while measuring"
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def stats(times):
+    "Summary of a list of durations in seconds"
+    times = sorted(times)
+    return dict(min=times[0], mean=sum(times) / len(times), max=times[-1], count=len(times))
+
+
+BUSY = None                 # One sampler shared by every manager
+
+
+def new_manager(filename, cache=None):
+    global BUSY     # pylint: disable=global-statement
+    if not BUSY:
+        BUSY = LazyCron.Busy()
+        BUSY.warm()
+    twatch = timewatch.TimeWatch()
+    twatch.idle = 3600
+    twatch.elapsed = twatch.today_elapsed = 3600
+    sman = LazyCron.ScriptManager(BUSY, twatch, filename, cache=cache)
+    sman.alert = lambda *args: None
+    return sman
+
+
+def bench(lines, ticks=5, memory=True, folder='/tmp'):
+    "Benchmark a schedule with this many lines and return a dict of results"
+    filename = os.path.join(folder, 'LazyCron_bench.' + str(lines) + '.txt')
+    with open(filename, 'w') as f:
+        f.write(gen_schedule(lines))
+    result = dict(lines=lines)
+
+    with quiet():
+        # Tokenizer only, compared to the original regex version
+        text = [line.strip() for line in open(filename) if line.strip() and not line.startswith('#')]
+        for name, func in (('read_line', LazyCron.read_line), ('read_line_regex', reference_read_line)):
+            start = time.perf_counter()
+            for line in text:
+                func(line)
+            result[name] = time.perf_counter() - start
+
+        # Full parse
+        sman = new_manager(filename)
+        start = time.perf_counter()
+        sman.read_schedule()
+        result['read_schedule'] = time.perf_counter() - start
+        result['apps'] = len(sman.schedule_apps)
+
+        # Reload with one edited line
+        with open(filename, 'a') as f:
+            f.write('*\t*\t*\t*\t# edited\n')
+        start = time.perf_counter()
+        sman.read_schedule()
+        result['reload'] = time.perf_counter() - start
+
+        # Startup with a cold and then a warm schedule cache
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('cache_cold', 'cache_warm'):
+                start = time.perf_counter()
+                new_manager(filename, ScheduleCache(tmp)).read_schedule()
+                result[name] = time.perf_counter() - start
+
+        # Time windows
+        start = time.perf_counter()
+        for app in sman.schedule_apps:
+            app.calc_window()
+        result['calc_window'] = time.perf_counter() - start
+
+        # First tick checks every app, the following ones only the apps that are due
+        full = []
+        due = []
+        for _tick in range(ticks):
+            sman.queue.reset(sman.schedule_apps)
+            start = time.perf_counter()
+            sman.run_scripts(60)
+            full.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            sman.run_scripts(60)
+            due.append(time.perf_counter() - start)
+        result['tick_all'] = stats(full)
+        result['tick_due'] = stats(due)
+
+        if memory:
+            tracemalloc.start()
+            sman = new_manager(filename)
+            sman.read_schedule()
+            sman.run_scripts(60)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    os.remove(filename)
+    return result
+
+
+def version():
+    "Git revision of the code being tested"
+    ret = subprocess.run(('git', 'describe', '--always', '--dirty'), check=False,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    return ret.stdout.decode().strip() if not ret.returncode else None
+
+
+def parse_args():
+    "Parse arguments"
+    args = [\
+    ['sizes', '', str, '10,100,1000,10000'],
+    "Comma separated list of schedule lengths to test (up to 100000)",
+    ['ticks', '', int, 5],
+    "Number of run_scripts calls to time for each size",
+    ['nomem', '', bool],
+    "Skip measuring peak memory (tracemalloc is slow)",
+    ['output', '', str],
+    "Write json to this file instead of stdout",
+    ['verify', '', bool],
+    "Check read_line against the original version on a corpus of tricky lines and quit",
+    ]
+    return easy_parse(args, usage='--sizes 10,1000', description='Benchmark the LazyCron scheduler.')
+
+
+def main():
+    uargs = parse_args()
+    stub()
+    if uargs.verify:
+        errors = verify()
+        print(len(corpus()), "lines checked,", errors, "mismatches", file=sys.stderr)
+        sys.exit(bool(errors))
+    out = dict(version=version(),
+               python=platform.python_version(),
+               date=time.strftime('%Y-%m-%d %H:%M'),
+               results=[],
+               )
+    for size in map(int, uargs.sizes.split(',')):
+        print("Testing", size, "lines...", file=sys.stderr)
+        out['results'].append(bench(size, uargs.ticks, memory=not uargs.nomem))
+
+    text = json.dumps(out, indent=2)
+    if uargs.output:
+        with open(uargs.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# Resource caps for jobs (linux only)
+# Each run gets its own cgroup v2 when LazyCron has a delegated cgroup, otherwise rlimits are set in the child
+
+import os
+import re
+import resource
+import itertools
+
+from shared import aprint
+from devices import unescape
+from how_busy_linux import is_link, descendants
+from sd.common import qwarn as warn
+
+
+CPU_PERIOD = 100000                 # Microseconds, cpu.max quotas are a share of this
+CONTROLLERS = dict(cpumax='cpu', memmax='memory', iomax='io', pids='pids')     # Req to cgroup controller
+RLIMITS = dict(memmax=resource.RLIMIT_AS)                                       # Req to fallback rlimit
+
+
+def cgroup_mount():
+    "Return where the cgroup v2 hierarchy is mounted or None"
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields, extra = line.split(' - ', 1)
+            if extra.split()[0] == 'cgroup2':
+                return unescape(fields.split()[4])
+    return None
+
+
+def own_cgroup():
+    "Return the cgroup v2 path of this process, like /user.slice/user-1000.slice/user@1000.service/app.slice/lazycron.service"
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            if line.startswith('0::'):
+                return line[3:].strip()
+    return None
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def disk_numbers():
+    "Return major:minor of every whole disk for io.max"
+    out = []
+    for dev in sorted(os.listdir('/sys/block')):
+        if is_link(dev):
+            continue
+        try:
+            with open(os.path.join('/sys/block', dev, 'dev')) as f:
+                out.append(f.read().strip())
+        except OSError:
+            continue
+    return out
+
+
+def join_cgroup(procs):
+    "Move the current process into a cgroup through its cgroup.procs file, run in the child before exec"
+    fd = os.open(procs, os.O_WRONLY)
+    try:
+        # 0 = the process writing it
+        os.write(fd, b'0')
+    finally:
+        os.close(fd)
+
+
+def set_rlimit(limit, val):
+    "Lower a resource limit in the child before exec"
+    _soft, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        val = min(val, hard)
+    resource.setrlimit(limit, (val, val))
+
+
+class Cgroups:
+    '''Put each run in its own cgroup with cpu, memory, io and pid limits
+    Only possible when LazyCron is alone in a cgroup it can write to,
+    like a systemd user service with Delegate=yes. Otherwise limits fall back to rlimits.'''
+
+    def __init__(self,):
+        self.jobs = None                    # Folder holding the job cgroups, None = not available
+        self.controllers = set()            # Controllers enabled for jobs
+        self.checked = False
+        self.counter = itertools.count()
+        self.leftover = []                  # Job cgroups that still had processes when the job finished
+        self.warned = set()
+
+
+    def setup(self,):
+        "Create the cgroup for jobs on first use, return True if cgroups are available"
+        if not self.checked:
+            self.checked = True
+            try:
+                self.jobs = self._setup()
+                aprint("Job limits are set with cgroups in", self.jobs, v=2)
+            except (OSError, ValueError) as e:
+                aprint("Job limits are set with rlimits, cgroups not available:", e, v=2)
+                self.jobs = None
+        return bool(self.jobs)
+
+
+    def _setup(self,):
+        mount = cgroup_mount()
+        path = own_cgroup()
+        if not mount or not path:
+            raise OSError("No cgroup v2 hierarchy")
+        base = os.path.join(mount, path.lstrip('/'))
+        if not os.access(os.path.join(base, 'cgroup.subtree_control'), os.W_OK):
+            raise OSError("Not delegated: " + base)
+
+        with open(os.path.join(base, 'cgroup.procs')) as f:
+            procs = f.read().split()
+        ours = {os.getpid()} | set(descendants(os.getpid()))
+        if any(int(pid) not in ours for pid in procs):
+            raise OSError("Other programs share " + base)
+
+        with open(os.path.join(base, 'cgroup.controllers')) as f:
+            available = set(f.read().split())
+        wanted = sorted(available & set(CONTROLLERS.values()))
+        if not wanted:
+            raise OSError("No controllers delegated to " + base)
+
+        # Cgroups with controllers enabled for their children can't hold processes, so LazyCron moves into a leaf
+        own = os.path.join(base, 'lazycron')
+        os.makedirs(own, exist_ok=True)
+        for pid in procs:
+            write(os.path.join(own, 'cgroup.procs'), pid)
+        enable = ' '.join('+' + name for name in wanted)
+        write(os.path.join(base, 'cgroup.subtree_control'), enable)
+        jobs = os.path.join(base, 'jobs')
+        os.makedirs(jobs, exist_ok=True)
+        write(os.path.join(jobs, 'cgroup.subtree_control'), enable)
+        self.controllers = set(wanted)
+        return jobs
+
+
+    def warn_once(self, req, *args):
+        if req not in self.warned:
+            self.warned.add(req)
+            warn(*args)
+
+
+    def create(self, name, limits):
+        '''Make a cgroup for one run with limits = dict of req name to value, return its path
+        cpumax = percent of one core, memmax = bytes, iomax = bytes per second on each disk, pids = processes'''
+        self.cleanup()
+        path = os.path.join(self.jobs, re.sub(r'[^\w.-]', '_', name) + '.' + str(next(self.counter)))
+        os.makedirs(path, exist_ok=True)
+        for req, val in limits.items():
+            if CONTROLLERS[req] not in self.controllers:
+                self.warn_once(req, "The", CONTROLLERS[req], "controller isn't delegated to LazyCron, ignoring", req)
+            elif req == 'cpumax':
+                write(os.path.join(path, 'cpu.max'), '{} {}'.format(max(int(val / 100 * CPU_PERIOD), 1000), CPU_PERIOD))
+            elif req == 'memmax':
+                write(os.path.join(path, 'memory.max'), str(int(val)))
+            elif req == 'iomax':
+                for dev in disk_numbers():
+                    try:
+                        write(os.path.join(path, 'io.max'), '{} rbps={} wbps={}'.format(dev, int(val), int(val)))
+                    except OSError:
+                        # Devices without an io scheduler
+                        continue
+            elif req == 'pids':
+                write(os.path.join(path, 'pids.max'), str(int(val)))
+        return path
+
+
+    def peak(self, path):
+        "Return the most memory a job cgroup used in bytes, None without the memory controller"
+        try:
+            with open(os.path.join(path, 'memory.peak')) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+
+    def remove(self, path):
+        "Remove a job cgroup after the job finishes, or later if programs it started are still running"
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            self.leftover.append(path)
+
+
+    def cleanup(self,):
+        leftover = self.leftover
+        self.leftover = []
+        for path in leftover:
+            self.remove(path)
+
+
+    def rlimits(self, limits):
+        "Return [(rlimit, value)] for the limits that have an rlimit, for when cgroups aren't available"
+        out = []
+        for req, val in limits.items():
+            if req in RLIMITS:
+                out.append((RLIMITS[req], int(val)))
+            else:
+                self.warn_once(req, req, "needs a delegated cgroup v2 to work, see the Readme. Ignoring", req)
+        return out
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# Heap of the next time each App could possibly be run
+
+import heapq
+import itertools
+
+
+class DeadlineQueue:
+    "Keep track of the earliest time each App needs to be checked again"
+
+    def __init__(self,):
+        self.heap = []                      # [deadline, counter, app, valid]
+        self.entries = {}                   # App id to its current heap entry
+        self.counter = itertools.count()    # Tie breaker so apps are never compared
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, app, deadline):
+        "Set a new deadline for app, replacing any older one"
+        self.discard(app)
+        if deadline == float('inf'):
+            # Never needs to be checked again (until the schedule is reloaded)
+            return
+        entry = [deadline, next(self.counter), app, True]
+        self.entries[id(app)] = entry
+        heapq.heappush(self.heap, entry)
+
+    def discard(self, app):
+        "Remove an app from the queue if it's in there"
+        entry = self.entries.pop(id(app), None)
+        if entry:
+            entry[-1] = False               # Lazy deletion, skipped when popped
+
+    def reset(self, apps, deadline=0):
+        "Start over with a new list of apps, all due at deadline"
+        self.heap = []
+        self.entries = {}
+        for app in apps:
+            self.push(app, deadline)
+
+    def pop_due(self, now):
+        "Remove and return every app with a deadline at or before now"
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if entry[-1]:
+                app = entry[2]
+                del self.entries[id(app)]
+                due.append(app)
+        return due
+
+    def deadline(self, app):
+        "Current deadline for app or inf if it isn't queued"
+        entry = self.entries.get(id(app))
+        return entry[0] if entry else float('inf')
+
+    def next_deadline(self,):
+        "Earliest deadline in the queue or inf if empty"
+        while self.heap and not self.heap[0][-1]:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return float('inf')
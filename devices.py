@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# Find the block devices behind a path or device name (linux only)
+
+import os
+import re
+
+
+def unescape(text):
+    "Mount points in mountinfo have spaces and such written as octal escapes"
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), text)
+
+
+def find_mount(path):
+    "Return (major:minor, mount source) of the filesystem holding path, or None"
+    path = os.path.realpath(os.path.expanduser(path))
+    best = None
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields, extra = line.split(' - ', 1)
+            fields = fields.split()
+            mount = unescape(fields[4])
+            if path == mount or path.startswith(mount.rstrip('/') + '/'):
+                if not best or len(mount) >= len(best[0]):
+                    best = (mount, fields[2], unescape(extra.split()[1]))
+    return best[1:] if best else None
+
+
+def whole_disks(name):
+    '''Return the disks under a block device name
+    Partitions become their disk, device mapper (lvm, luks) and raid devices become the disks they are built on'''
+    sysfs = os.path.join('/sys/class/block', name)
+    if not os.path.exists(sysfs):
+        return []
+    slaves = os.path.join(sysfs, 'slaves')
+    if os.path.isdir(slaves) and os.listdir(slaves):
+        out = []
+        for slave in sorted(os.listdir(slaves)):
+            out += [disk for disk in whole_disks(slave) if disk not in out]
+        return out
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        return [os.path.basename(os.path.dirname(os.path.realpath(sysfs)))]
+    return [name]
+
+
+def block_devices(target):
+    "Return a list of disk names for a device name like sda1, /dev/mapper/home or a path on a mounted filesystem"
+    if target.startswith('/dev/'):
+        return whole_disks(os.path.basename(os.path.realpath(target)))
+    if '/' not in target and not target.startswith('~'):
+        return whole_disks(target)
+
+    found = find_mount(target)
+    if not found:
+        return []
+    majmin, source = found
+    # Use the mount source where possible, btrfs and others report an anonymous device number
+    if source.startswith('/dev/') and os.path.exists(source):
+        disks = whole_disks(os.path.basename(os.path.realpath(source)))
+        if disks:
+            return disks
+    link = os.path.join('/sys/dev/block', majmin)
+    if os.path.exists(link):
+        return whole_disks(os.path.basename(os.path.realpath(link)))
+    return []
+
+
+if __name__ == "__main__":
+    import sys
+    for arg in sys.argv[1:] or ['/']:
+        print(arg, '=', block_devices(arg))
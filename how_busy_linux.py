@@ -1,135 +1,262 @@
 #!/usr/bin/python3
 # how_busy functions for linux only
-
-# Kib vs KB
-# iostat uses KiB: https://man7.org/linux/man-pages/man1/iostat.1.html
-# sar uses KiB: https://man7.org/linux/man-pages/man1/sar.1.html
+# Reads the kernel counters in /proc directly, so nothing needs to be installed or forked
 # All numbers are converted to base units of bytes for simplicity
 
 
-import shutil
+import os
+import time
+import functools
 from sd.columns import auto_cols
-from sd.common import avg, sorted_array, flatten, quickrun, DotDict
+from sd.common import sorted_array
+
+
+
+def read_cpu():
+    "Return (busy, total) cpu time from /proc/stat"
+    with open('/proc/stat') as f:
+        fields = list(map(int, f.readline().split()[1:]))
+    # user nice system idle iowait irq softirq steal (guest time is already counted in user)
+    total = sum(fields[:8])
+    return total - sum(fields[3:5]), total
+
+
+def is_link(dev):
+    "Is the device built on top of other devices or files?"
+    return dev.startswith('dm-') or dev.startswith('loop')
+
+
+def read_disks(ignore_links=True):
+    "Return bytes read and written for each whole disk from /proc/diskstats"
+    out = {}
+    with open('/proc/diskstats') as f:
+        for line in f:
+            fields = line.split()
+            dev = fields[2]
+            if ignore_links and is_link(dev):
+                continue
+            # Partitions are counted in their disk
+            if not os.path.exists(os.path.join('/sys/block', dev.replace('/', '!'))):
+                continue
+            # Sectors read and written are always 512 bytes in /proc/diskstats
+            out[dev] = (int(fields[5]) + int(fields[9])) * 512
+    return out
+
+
+def read_interfaces():
+    "Return bytes received and sent for each interface from /proc/net/dev"
+    out = {}
+    with open('/proc/net/dev') as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(':', 1)
+            data = data.split()
+            out[name.strip()] = int(data[0]) + int(data[8])
+    return out
+
+
+def read_pressure():
+    "Return the total microseconds that some tasks were stalled waiting for each resource in /proc/pressure"
+    out = {}
+    for kind in ('cpu', 'io', 'memory'):
+        try:
+            with open(os.path.join('/proc/pressure', kind)) as f:
+                line = f.readline()
+        except OSError:
+            # Older kernels or booted with psi=0
+            continue
+        out[kind] = int(line.rsplit('total=', 1)[1])
+    return out
+
+
+def read_memory():
+    "Return (bytes available, bytes of swap used) from /proc/meminfo"
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, val = line.split(':', 1)
+            info[name] = int(val.split()[0]) * 1024
+    # MemAvailable is missing before linux 3.14
+    available = info.get('MemAvailable', info['MemFree'] + info.get('Cached', 0))
+    return available, info.get('SwapTotal', 0) - info.get('SwapFree', 0)
+
+
+def read_load():
+    "Return the 5 minute load average per cpu core"
+    with open('/proc/loadavg') as f:
+        return float(f.read().split()[1]) / (os.cpu_count() or 1)
+
+
+def children(pid):
+    "Return the child pids of a process, or None if the kernel doesn't list them"
+    try:
+        tasks = os.listdir(os.path.join('/proc', str(pid), 'task'))
+    except OSError:
+        return []
+    out = []
+    for tid in tasks:
+        try:
+            with open(os.path.join('/proc', str(pid), 'task', tid, 'children')) as f:
+                out += map(int, f.read().split())
+        except FileNotFoundError:
+            # Kernel built without CONFIG_PROC_CHILDREN
+            return None
+        except OSError:
+            continue
+    return out
 
 
+@functools.lru_cache(maxsize=None)
+def lists_children():
+    "Does the kernel list the children of each process? Otherwise finding them means reading all of /proc"
+    return children(os.getpid()) is not None
 
 
-# See what commands are available
-AVAIL = DotDict()
-for cmd, msg in dict(mpstat='CPU monitoring will not function.',
-                     sar='Network monitor will not function.',
-                     iostat='Disk usage monitor will not function.',
-                     ).items():
-    if not shutil.which(cmd):
-        print('Warning!', cmd, 'is not available.', msg)
-        AVAIL[cmd] = False
-    else:
-        AVAIL[cmd] = True
+def descendants(pid):
+    "Return the pids of every process started by pid, and their children and so on"
+    out = []
+    found = children(pid)
+    if found is None:
+        # Look through every process for its parent instead
+        parents = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open(os.path.join('/proc', name, 'stat')) as f:
+                        parents.setdefault(int(f.read().rsplit(')', 1)[1].split()[1]), []).append(int(name))
+                except OSError:
+                    continue
+        stack = [pid]
+        while stack:
+            found = parents.get(stack.pop(), [])
+            out += found
+            stack += found
+        return out
 
+    stack = found
+    while stack:
+        child = stack.pop()
+        out.append(child)
+        stack += children(child) or []
+    return out
+
+
+def read_io(pid):
+    "Return the counters in /proc/<pid>/io, which include children that have been reaped"
+    out = {}
+    with open(os.path.join('/proc', str(pid), 'io')) as f:
+        for line in f:
+            name, val = line.split(':')
+            out[name] = int(val)
+    return out
+
+
+def read_tree(pid=None):
+    '''Return (cpu ticks, bytes read and written to disk) used by a process and everything it started
+    Programs that have finished are included, the kernel adds them to their parent when they are reaped'''
+    pid = pid or os.getpid()
+    cpu = 0
+    disk = 0
+    for proc in [pid] + descendants(pid):
+        try:
+            with open(os.path.join('/proc', str(proc), 'stat')) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime, stime, cutime, cstime
+            cpu += sum(map(int, fields[11:15]))
+            io = read_io(proc)
+            disk += io['read_bytes'] + io['write_bytes']
+        except (OSError, ValueError):
+            # Finished before we could read it
+            continue
+    return cpu, disk
+
+
+def add_foreign(out, seconds=False):
+    '''Add foreign: counters to a counters() dict with the usage of LazyCron and its programs taken out
+    seconds = cpu_busy is in seconds (psutil) instead of clock ticks
+    Left out if the kernel doesn't list children, it's too slow to find them every sample'''
+    if not lists_children():
+        return out
+    own_cpu, own_disk = read_tree()
+    if seconds:
+        own_cpu /= os.sysconf('SC_CLK_TCK')
+    out['foreign:cpu_busy'] = out['cpu_busy'] - own_cpu
+    out['foreign:disk'] = out['disk'] - own_disk
+    return out
+
+
+def counters():
+    '''Return cumulative counters for the sampler
+    Per disk counters are named disk:<device>, interfaces are named net:<interface> and stall times are named pressure:<cpu, io or memory>
+    Counters named foreign:<name> leave out the usage of LazyCron and its programs
+    mem, swap and load are current levels, not counters'''
+    busy, total = read_cpu()
+    disks = read_disks(ignore_links=False)
+    interfaces = read_interfaces()
+    out = dict(cpu_busy=busy,
+               cpu_total=total,
+               disk=sum(val for dev, val in disks.items() if not is_link(dev)),
+               net=sum(interfaces.values()),
+               load=read_load(),
+               )
+    out['mem'], out['swap'] = read_memory()
+    for dev, val in disks.items():
+        out['disk:' + dev] = val
+    for name, val in interfaces.items():
+        out['net:' + name] = val
+    for kind, val in read_pressure().items():
+        out['pressure:' + kind] = val
+    return add_foreign(out)
+
+
+def rates(read, wait):
+    "Call read() before and after waiting, return the change per second for each key"
+    start = read()
+    time.sleep(wait)
+    end = read()
+    return {key: max(end[key] - start.get(key, end[key]), 0) / wait for key in end}
+
+
+def show_rates(table, header):
+    "Print a table of rates in MB/s"
+    out = [[header, 'MB/s']]
+    out += [[key, round(val / 1e6, 3)] for key, val in table.items()]
+    out = [out[0]] + list(sorted_array(out[1:], reverse=True))
+    auto_cols(out)
 
 
 def get_cpu_usage(interval=1, samples=4):
-    if not AVAIL.mpstat:
+    "Return cpu usage as percentage"
+    busy, total = read_cpu()
+    time.sleep(interval * samples)
+    busy2, total2 = read_cpu()
+    if total2 <= total:
         return 0
-    out = quickrun(['mpstat', interval, samples])
-    idle = out[-1].split()[-1]
-    return 100 - float(idle)
+    return 100 * (busy2 - busy) / (total2 - total)
 
 
 def get_network_usage(interval=1, samples=4, verbose=0):
-    '''Return total network usage in Bytes / second, adds up rxkB/s and txkB/s columns from sar
-    Requires: sudo apt install sysstat'''
-    if not AVAIL.sar:
-        return 0
-
-    out = quickrun('sar', '-n', 'DEV', interval, samples, verbose=verbose)
+    '''Return total network usage in Bytes / second, adds up bytes received and sent on every interface'''
+    table = rates(read_interfaces, interval * samples)
     if verbose:
-        auto_cols(map(str.split, out[-3:]))
-    out = [line for line in out if line.startswith('Average:')]
-    out = flatten([line.split()[4:6] for line in out[1:]])
-    return int(sum(map(float, out)) * 1024)
+        show_rates(table, 'Interface')
+    return int(sum(table.values()))
 
 
 def all_disk_usage(interval=2, reps=4, verbose=0, ignore_links=True):
     '''Return total i/o for all devices in Bytes / second
     ignore_links will ignore loop and dm-? devs for total'''
-    if not AVAIL.iostat:
-        return 0
-
-    ready = False
-    total = 0
-    table = dict()
-    rep = -1
-    for line in quickrun('nice', 'iostat', '-d', interval, reps + 1, verbose=verbose):
-        if verbose >= 2:
-            print(rep, line)
-        if not line:
-            continue
-        if line.startswith('Device'):
-            ready = True
-            rep += 1
-            continue
-        if ready and rep > 0:
-            # Skip the first rep because it contains bad data
-            line = line.split()
-            dev = line[0]
-            usage = sum(map(float, line[2:4]))
-            table.setdefault(dev, []).append(usage)
-            if ignore_links and (dev.startswith('dm-') or dev.startswith('loop')):
-                continue
-            total += usage
+    table = rates(lambda: read_disks(ignore_links), interval * reps)
     if verbose:
-        out = [['Device'] + ['Rep ' + str(rep + 1) for rep in range(reps)] + ['', 'Average MB/s']]
-        for dev in sorted(table.keys()):
-            out.append([dev] + list(map(int, table[dev])))
-            out[-1] += ['=', int(avg(table[dev]))]
-        out = [out[0]] + list(sorted_array(out[1:], reverse=True))
-        auto_cols(out, manual={-3: 2, -2: 2})
-    return int(total / reps * 1024)
-
-
-
-
-
-'''
-def get_device_usage(dev, wait=2, reps=4, verbose=0):
-    "Check how busy the device is"
-    if reps < 2:
-        reps = 2
-
-    usage = []
-    get_ready = False     #next line contains the percentage
-    for line in quickrun('nice', 'iostat', '-d', '-x', dev, wait, reps + 1, verbose=verbose):
-        val = re.split(' +', line)[-1]
-        if get_ready:
-            usage.append(float(val))
-        get_ready = bool(val == '%util')
-    # print(dev+':', usage[1:], '=', percent(avg(usage[1:])))
-    return int(avg(usage[1:]) * 1024)
-
-def wait_until_not_busy(folder, threshold=11, wait=2, reps=8, delta=2, sleep=2):
-    "Threshold in % points
-    Loop waiting until device isn't busy.
-    every loop the threshold grows higher by delta"
-
-    dev = find_device(folder)
-    print("Probing", dev)
-
-    for x in itertools.count():
-        usage = get_device_usage(dev, wait, reps)
-        if usage * 100 < threshold:
-            break
-        else:
-            print(percent(usage), '>', int(threshold))
-        threshold += ((x + 1) * delta)
-        time.sleep(x * sleep)
-'''
+        show_rates(table, 'Device')
+    return int(sum(table.values()))
+
+
 
 def test():
-    print('Utilities available:', AVAIL)
-    print("Disk Usage (MB/S):", all_disk_usage() / 1e6)
+    print('Counters:', counters())
+    print("Disk Usage (MB/S):", all_disk_usage(verbose=1) / 1e6)
     print("Cpu Usage:", get_cpu_usage())
-    print("Network Usage:", get_network_usage())
+    print("Network Usage:", get_network_usage(verbose=1))
 
 
 if __name__ == "__main__":
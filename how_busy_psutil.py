@@ -2,9 +2,12 @@
 # how_busy functions coded with psutil
 # All numbers are returned in bytes for simplicity
 
+import os
 import time
 import psutil
 
+from how_busy_linux import read_pressure, add_foreign
+
 
 def get_cpu_usage(interval=1, samples=4):
     "Return cpu usage as percentage"
@@ -53,6 +56,38 @@ def all_disk_usage(interval=2, reps=4, verbose=0, ignore_links=True):
 
 
 
+def counters():
+    "Return cumulative counters for the sampler"
+    cpu = psutil.cpu_times()
+    total = sum(cpu)
+    # Guest time is already counted in user time on linux
+    total -= getattr(cpu, 'guest', 0) + getattr(cpu, 'guest_nice', 0)
+    idle = cpu.idle + getattr(cpu, 'iowait', 0)
+    disk = psutil.disk_io_counters()
+    net = psutil.net_io_counters()
+    out = dict(cpu_busy=total - idle,
+               cpu_total=total,
+               disk=disk.read_bytes + disk.write_bytes if disk else 0,
+               net=net.bytes_sent + net.bytes_recv,
+               mem=psutil.virtual_memory().available,
+               swap=psutil.swap_memory().used,
+               load=psutil.getloadavg()[1] / (psutil.cpu_count() or 1),
+               )
+    # Per disk counters named disk:<device>, partitions are left out on linux. Interfaces are named net:<interface>
+    for dev, val in psutil.disk_io_counters(perdisk=True).items():
+        if os.path.isdir('/sys/block') and not os.path.exists(os.path.join('/sys/block', dev)):
+            continue
+        out['disk:' + dev] = val.read_bytes + val.write_bytes
+    for name, val in psutil.net_io_counters(pernic=True).items():
+        out['net:' + name] = val.bytes_sent + val.bytes_recv
+    # psutil doesn't read pressure stall information or know about reaped children
+    for kind, val in read_pressure().items():
+        out['pressure:' + kind] = val
+    if os.path.isdir('/proc/self/task'):
+        add_foreign(out, seconds=True)
+    return out
+
+
 def test():
     print("psutil Disk Usage (MB/S):", all_disk_usage() / 1e6)
     print("psutil Cpu Usage:", get_cpu_usage())
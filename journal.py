@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# Keep App history and TimeWatch counters on disk so they survive a restart
+# Changes are appended to a journal and compacted into a snapshot every so often
+
+import os
+import json
+import time
+
+from shared import aprint
+from sd.common import mkdir, qwarn as warn
+
+
+HISTORY_LIMIT = 1000            # Timestamps kept per app, older runs are only counted
+COMPACT_LINES = 1000            # Journal lines before rewriting the snapshot
+
+
+def write_atomic(filename, text, sync=True):
+    "Write a file so that readers only ever see the old or new version, sync=False skips waiting for the disk"
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb' if isinstance(text, bytes) else 'w') as f:
+        f.write(text)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+class Journal:
+    "Append only record of app runs with a periodic snapshot"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.snapshot = os.path.join(folder, 'state.json')
+        self.filename = os.path.join(folder, 'journal.jsonl')
+        self.apps = {}                  # App key to saved state
+        self.twatch = {}                # Saved TimeWatch counters
+        self.buffer = []                # Lines waiting to be written
+        self.seq = 0                    # Sequence number of the last record
+        self.lines = 0                  # Lines in journal since last snapshot
+        self.file = None
+
+        mkdir(folder)
+        self.load()
+        self.compact()
+
+
+    def load(self,):
+        "Read the snapshot and replay the journal on top of it"
+        if os.path.exists(self.snapshot):
+            try:
+                with open(self.snapshot) as f:
+                    data = json.load(f)
+                self.apps = data.get('apps', {})
+                self.twatch = data.get('twatch', {})
+                self.seq = data.get('seq', 0)
+            except (OSError, ValueError) as e:
+                warn("Could not read state snapshot:", self.snapshot, e)
+
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partially written line from a crash
+                        continue
+                    # Skip records already in the snapshot (crash during compaction)
+                    if record.get('seq', 0) > self.seq:
+                        self.seq = record['seq']
+                        self._apply(record)
+        aprint("Loaded state for", len(self.apps), "apps from", self.folder, v=2)
+
+
+    def _apply(self, record):
+        "Update the in memory state with a journal record"
+        if 'twatch' in record:
+            self.twatch = record['twatch']
+            return
+
+        if 'parent' in record:
+            # Copy history from the app this one replaced
+            parent = self.apps.get(record['parent'], dict(count=0, history=[]))
+            self.apps[record['key']] = dict(count=parent['count'], history=list(parent['history']))
+
+        state = self.apps.setdefault(record['key'], dict(count=0, history=[], next_run=0, elapsed_next=0))
+        if record.get('run'):
+            state['count'] += 1
+            state['history'].append(record['run'])
+            if len(state['history']) > HISTORY_LIMIT * 2:
+                del state['history'][:-HISTORY_LIMIT]
+        state['next_run'] = record['next_run']
+        state['elapsed_next'] = record['elapsed_next']
+
+
+    def _append(self, record):
+        self.seq += 1
+        record['seq'] = self.seq
+        self._apply(record)
+        self.buffer.append(json.dumps(record, separators=(',', ':')))
+
+
+    def record_app(self, app, ran):
+        "Save the state of an app after App.run, ran = True if a timestamp was added to history"
+        self._append(dict(key=app.key,
+                          run=app.history[-1] if ran else None,
+                          next_run=app.next_run,
+                          elapsed_next=app.elapsed_next,
+                          ))
+
+
+    def record_inherit(self, app, parent):
+        "Save an app that took over the history of an edited line"
+        self._append(dict(key=app.key,
+                          parent=parent.key,
+                          next_run=app.next_run,
+                          elapsed_next=app.elapsed_next,
+                          ))
+
+
+    def record_twatch(self, twatch):
+        "Save the TimeWatch counters if they've changed"
+        state = dict(elapsed=int(twatch.elapsed),
+                     today=int(twatch.today_elapsed),
+                     date=time.strftime('%Y-%m-%d'),
+                     )
+        if state != self.twatch:
+            self._append(dict(twatch=state))
+
+
+    def restore_app(self, app):
+        "Load the saved state into a new app, return True if found"
+        state = self.apps.get(app.key)
+        if not state:
+            return False
+        history = state['history'][-HISTORY_LIMIT:]
+        # Runs older than the saved history still count toward max
+        app.history = [0] * (state['count'] - len(history)) + history
+        app.next_run = state['next_run']
+        app.elapsed_next = state['elapsed_next']
+        return True
+
+
+    def restore_twatch(self, twatch):
+        "Load the saved elapsed counters into a TimeWatch"
+        if self.twatch:
+            twatch.elapsed = self.twatch['elapsed']
+            if self.twatch['date'] == time.strftime('%Y-%m-%d'):
+                twatch.today_elapsed = self.twatch['today']
+
+
+    def flush(self,):
+        "Write buffered records with a single fsync, compact if the journal is too long"
+        if not self.buffer:
+            return
+        if not self.file:
+            self.file = open(self.filename, 'a')
+        self.file.write('\n'.join(self.buffer) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lines += len(self.buffer)
+        self.buffer = []
+        if self.lines >= COMPACT_LINES:
+            self.compact()
+
+
+    def compact(self,):
+        "Write the current state to the snapshot and empty the journal"
+        if self.file:
+            self.file.close()
+            self.file = None
+        for state in self.apps.values():
+            del state['history'][:-HISTORY_LIMIT]
+        write_atomic(self.snapshot, json.dumps(dict(apps=self.apps, twatch=self.twatch, seq=self.seq)))
+        with open(self.filename, 'w'):
+            pass
+        self.lines = 0
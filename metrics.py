@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# Scheduler metrics in the Prometheus text format
+# Written to a file for the node_exporter textfile collector or served over http
+
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from journal import write_atomic
+from sd.common import qwarn as warn
+
+
+TICK_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+RUN_BUCKETS = (1, 10, 60, 300, 900, 3600, 4 * 3600, 12 * 3600)
+
+
+def fmt_labels(labels):
+    "Convert a tuple of (name, value) pairs to Prometheus label text"
+    if not labels:
+        return ''
+    escape = lambda text: str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(name, escape(val)) for name, val in labels) + '}'
+
+
+def fmt_num(num):
+    if num == float('inf'):
+        return '+Inf'
+    return repr(float(num)) if isinstance(num, float) else str(num)
+
+
+class Metrics:
+    '''Counters, gauges and histograms keyed by name and labels
+    Safe to update from the supervisor thread while the main thread renders'''
+
+    def __init__(self,):
+        self.lock = threading.Lock()
+        self.kinds = {}                 # Metric name to (type, help text)
+        self.values = {}                # (name, labels) to value, or [bucket counts, sum, count] for histograms
+        self.buckets = {}               # Histogram name to bucket limits
+
+
+    def declare(self, name, kind, text, buckets=None):
+        "Set the type and help text for a metric"
+        self.kinds[name] = (kind, text)
+        if buckets:
+            self.buckets[name] = buckets
+
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+
+    def observe(self, name, value, **labels):
+        "Add a value to a histogram"
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.buckets[name]
+        with self.lock:
+            hist = self.values.get(key)
+            if hist is None:
+                hist = self.values[key] = [[0] * len(buckets), 0, 0]
+            for index, limit in enumerate(buckets):
+                if value <= limit:
+                    hist[0][index] += 1
+            hist[1] += value
+            hist[2] += 1
+
+
+    def render(self,):
+        "Return the metrics in the Prometheus text exposition format"
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: item[0])
+            values = [(key, [list(val[0])] + val[1:] if isinstance(val, list) else val) for key, val in values]
+        out = []
+        last = None
+        for (name, labels), val in values:
+            if name != last:
+                kind, text = self.kinds.get(name, ('untyped', ''))
+                out.append('# HELP {} {}'.format(name, text))
+                out.append('# TYPE {} {}'.format(name, kind))
+                last = name
+            if isinstance(val, list):
+                counts, total, count = val
+                for limit, bucket in zip(self.buckets[name] + (float('inf'),), counts + [count]):
+                    out.append(name + '_bucket' + fmt_labels(labels + (('le', fmt_num(limit)),)) + ' ' + str(bucket))
+                out.append(name + '_sum' + fmt_labels(labels) + ' ' + fmt_num(float(total)))
+                out.append(name + '_count' + fmt_labels(labels) + ' ' + str(count))
+            else:
+                out.append(name + fmt_labels(labels) + ' ' + fmt_num(val))
+        return '\n'.join(out) + '\n'
+
+
+METRICS = Metrics()
+METRICS.declare('lazycron_tick_seconds', 'histogram', 'Time spent in each main loop iteration, not counting sleep',
+                TICK_BUCKETS)
+METRICS.declare('lazycron_apps', 'gauge', 'Apps in the schedule by scheduling state')
+METRICS.declare('lazycron_jobs_running', 'gauge', 'Jobs started and not finished yet, not counting jobs waiting for a slot')
+METRICS.declare('lazycron_jobs_waiting', 'gauge', 'Jobs waiting for a slot')
+METRICS.declare('lazycron_usage', 'gauge', 'Sampled system usage, bytes per second for disk and network')
+METRICS.declare('lazycron_twatch_seconds', 'gauge', 'TimeWatch counters')
+METRICS.declare('lazycron_job_starts_total', 'counter', 'Processes started, including loops and retries')
+METRICS.declare('lazycron_job_finishes_total', 'counter', 'Processes finished by exit code result')
+METRICS.declare('lazycron_job_failures_total', 'counter', 'Processes that returned an error or timed out')
+METRICS.declare('lazycron_job_runtime_seconds', 'histogram', 'Process run time', RUN_BUCKETS)
+
+
+class MetricsOutput:
+    '''Publish METRICS to a file each tick or over http
+    target = filename ending in .prom or [host]:port'''
+
+    def __init__(self, target, metrics=METRICS):
+        self.metrics = metrics
+        self.filename = None
+        self.server = None
+        found = re.fullmatch(r'([\w.-]*):(\d+)', target)
+        if found:
+            self.serve(found.group(1) or '127.0.0.1', int(found.group(2)))
+        else:
+            self.filename = target
+
+
+    def serve(self, host, port):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):      # pylint: disable=invalid-name
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):       # pylint: disable=arguments-differ
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            warn("Could not serve metrics on", host + ':' + str(port), e)
+            return
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True, name='metrics').start()
+
+
+    def write(self,):
+        "Write the metrics file if using one, the collector only needs it replaced atomically"
+        if self.filename:
+            try:
+                write_atomic(self.filename, self.metrics.render(), sync=False)
+            except OSError as e:
+                warn("Could not write metrics to", self.filename, e)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# Cpu and io scheduling policy for jobs, applied in the child before exec (linux only)
+# Everything is worked out in the parent, the child only makes the syscalls
+
+import os
+import ctypes
+import platform
+import functools
+
+from sd.common import qwarn as warn
+
+
+# ioprio_set isn't in the os module, so it's called through libc
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'arm64': 30, 'riscv64': 30,
+              'armv7l': 314, 'armv6l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+IOPRIO_NR = IOPRIO_SET.get(platform.machine())
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = dict(rt=1, realtime=1, be=2, besteffort=2, idle=3)
+
+SCHED_POLICIES = dict(idle='SCHED_IDLE', batch='SCHED_BATCH', other='SCHED_OTHER', normal='SCHED_OTHER')
+
+try:
+    LIBC = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    LIBC = None
+
+
+def parse_sched(text):
+    "Convert idle, batch or other to the os.SCHED_ constant, None if not available"
+    name = SCHED_POLICIES.get(text.lower().strip())
+    return getattr(os, name, None) if name else None
+
+
+def parse_ioclass(text):
+    '''Convert text like 'idle', 'be 4' or '4' to an io priority for ioprio_set, None if invalid
+    A number by itself is the best effort level: 0 is the highest priority, 7 the lowest'''
+    words = text.lower().replace('-', '').replace('_', '').split()
+    if not words:
+        return None
+    if words[0].isdigit():
+        words.insert(0, 'be')
+    if words[0] not in IOPRIO_CLASSES:
+        return None
+    ioclass = IOPRIO_CLASSES[words[0]]
+    level = 4 if ioclass != 3 else 0
+    if len(words) > 1:
+        if not words[1].isdigit() or not 0 <= int(words[1]) <= 7:
+            return None
+        level = int(words[1])
+    return ioclass << IOPRIO_CLASS_SHIFT | level
+
+
+def parse_cpus(text):
+    "Convert a cpu list like 0-3,6 to a sorted list of cpu numbers, None if invalid"
+    out = set()
+    for part in text.replace(' ', ',').split(','):
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                start, end = map(int, part.split('-'))
+                out.update(range(start, end + 1))
+            else:
+                out.add(int(part))
+        except ValueError:
+            return None
+    return sorted(out) or None
+
+
+def set_ioprio(ioprio):
+    "Set the io priority of the current process"
+    if LIBC.syscall(IOPRIO_NR, IOPRIO_WHO_PROCESS, 0, ioprio) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def set_sched(policy):
+    os.sched_setscheduler(0, policy, os.sched_param(0))
+
+
+def set_oom(score):
+    "Make the process more (up to 1000) or less (down to -1000, needs root) likely to be killed when out of memory"
+    fd = os.open('/proc/self/oom_score_adj', os.O_WRONLY)
+    try:
+        os.write(fd, score)
+    finally:
+        os.close(fd)
+
+
+def steps(reqs):
+    '''Return a list of (req name, function) to run in the child before exec for the sched, ioclass, cpus, oom and idleclass reqs
+    idleclass = only use cpu and disk time nothing else wants, unless sched or ioclass are given'''
+    out = []
+    policy = reqs('sched')
+    ioprio = reqs('ioclass')
+    if reqs('idleclass'):
+        if policy is None:
+            policy = getattr(os, 'SCHED_IDLE', None)
+        if ioprio is None:
+            ioprio = IOPRIO_CLASSES['idle'] << IOPRIO_CLASS_SHIFT
+    if policy is not None:
+        out.append(('sched', functools.partial(set_sched, policy)))
+    if ioprio is not None:
+        if LIBC is None or IOPRIO_NR is None:
+            warn("ioprio_set is not available on", platform.machine(), "ignoring ioclass")
+        else:
+            out.append(('ioclass', functools.partial(set_ioprio, ioprio)))
+    if reqs('cpus'):
+        out.append(('cpus', functools.partial(os.sched_setaffinity, 0, reqs('cpus'))))
+    if reqs('oom') is not None:
+        out.append(('oom', functools.partial(set_oom, str(reqs('oom')).encode())))
+    return out
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# Measure what LazyCron itself costs: time spent in each part of the main loop,
+# programs started, threads spawned and its own cpu time and memory
+
+import os
+import sys
+import time
+import resource
+import threading
+import contextlib
+import collections
+
+from sd.columns import auto_cols
+from sd.common import rfs
+
+
+class Phase:
+    "Running totals for one named part of the loop"
+    __slots__ = ('calls', 'total', 'most')
+
+    def __init__(self,):
+        self.calls = 0
+        self.total = 0
+        self.most = 0
+
+
+def read_rss():
+    "Current resident memory in bytes"
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak instead of current, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def own_cpu():
+    "Cpu seconds used by this process, not counting the programs it started"
+    times = os.times()
+    return times.user + times.system
+
+
+class Profiler:
+    '''Time phases of the main loop and count forks and threads
+    Does nothing until enable() is called, so the phase() calls can stay in the code'''
+
+    def __init__(self,):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.phases = collections.defaultdict(Phase)    # Phase name to totals
+        self.forks = collections.Counter()              # Program name to times started
+        self.threads = 0                                # Threads started
+        self.ticks = 0                                  # Main loop iterations
+        self.start_time = 0
+        self.start_cpu = 0
+        self.peak_rss = 0
+        self._null = contextlib.nullcontext()
+
+
+    def enable(self,):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.start_time = time.monotonic()
+        self.start_cpu = own_cpu()
+        # Audit hooks can't be removed, so this is only installed when profiling
+        sys.addaudithook(self._audit)
+        threading.setprofile(self._thread_started)
+
+
+    def _audit(self, event, args):
+        if event == 'subprocess.Popen':
+            executable, argv = args[0], args[1]
+            if argv and isinstance(argv, (list, tuple)):
+                # Show what the shell is running instead of just sh
+                prog = str(argv[-1]).split()[0] if len(argv) == 3 and argv[1] == '-c' else str(argv[0])
+            else:
+                prog = str(argv or executable or '?').split()[0]
+            with self.lock:
+                self.forks[os.path.basename(prog)] += 1
+        elif event in ('os.fork', 'os.forkpty', 'os.posix_spawn', 'os.system'):
+            with self.lock:
+                self.forks[event] += 1
+
+
+    def _thread_started(self, *_args):
+        "Called once at the start of every new thread, then removes itself"
+        sys.setprofile(None)
+        with self.lock:
+            self.threads += 1
+
+
+    def phase(self, name):
+        "Context manager to time a part of the loop: with PROFILE.phase('update'): ..."
+        if not self.enabled:
+            return self._null
+        return self._timer(name)
+
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                phase = self.phases[name]
+                phase.calls += 1
+                phase.total += elapsed
+                phase.most = max(phase.most, elapsed)
+
+
+    def call(self, name, func, *args, **kwargs):
+        "Time a single call without indenting it: PROFILE.call('reqs:online', check_internet)"
+        if not self.enabled:
+            return func(*args, **kwargs)
+        with self._timer(name):
+            return func(*args, **kwargs)
+
+
+    def tick(self,):
+        "Mark the end of a main loop iteration"
+        if self.enabled:
+            self.ticks += 1
+            self.peak_rss = max(self.peak_rss, read_rss())
+
+
+    def report(self,):
+        "Print a table of where the time went and what LazyCron has cost so far"
+        wall = time.monotonic() - self.start_time
+        cpu = own_cpu() - self.start_cpu
+        ticks = max(self.ticks, 1)
+        print('Profile over', round(wall), 'seconds and', self.ticks, 'loops:')
+        print('Own cpu time:', round(cpu, 3), 'seconds =',
+              round(100 * cpu / wall, 3) if wall else 0, '% of one core,',
+              round(1e3 * cpu / ticks, 3), 'ms per loop')
+        print('Memory:', rfs(read_rss()), 'now,', rfs(self.peak_rss), 'peak.',
+              'Threads:', threading.active_count(), 'now,', self.threads, 'started')
+
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1].total)
+            forks = self.forks.most_common()
+        if phases:
+            print()
+            out = [['Phase', 'Calls', 'Total ms', 'Mean ms', 'Max ms', 'ms/loop']]
+            for name, phase in phases:
+                out.append([name, phase.calls, round(1e3 * phase.total, 2),
+                            round(1e3 * phase.total / phase.calls, 3), round(1e3 * phase.most, 3),
+                            round(1e3 * phase.total / ticks, 3)])
+            auto_cols(out)
+        if forks:
+            print()
+            out = [['Program', 'Started', 'Per loop']]
+            out += [[name, count, round(count / ticks, 3)] for name, count in forks]
+            auto_cols(out)
+        print()
+
+
+PROFILE = Profiler()
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# Database of every run with its times, exit code and resources used
+# Usage: ./LazyCron.py stats [job] --days 30
+
+import os
+import math
+import time
+import sqlite3
+import threading
+import urllib.parse
+
+from sd.columns import auto_cols
+from sd.easy_args import easy_parse
+from sd.common import rfs, sig, qwarn as warn
+from sd.chronology import fmt_time
+
+
+FILENAME = 'runs.sqlite'
+COLUMNS = ('start', 'end', 'elapsed', 'code', 'attempt', 'retry', 'user', 'system', 'maxrss',
+           'read_bytes', 'write_bytes', 'inblock', 'oublock', 'nvcsw', 'nivcsw')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    start REAL, end REAL, elapsed REAL,
+    code INTEGER,                   -- NULL if killed at timeout
+    attempt INTEGER,                -- Run number within the job, counting loops and retries
+    retry INTEGER,                  -- 1 if the run was started again because the last one failed
+    user REAL, system REAL,
+    maxrss INTEGER,                 -- Peak memory of the job cgroup, NULL if the job didn't have one
+    read_bytes INTEGER, write_bytes INTEGER, inblock INTEGER, oublock INTEGER,
+    nvcsw INTEGER, nivcsw INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_job_start ON runs (job, start);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+'''
+
+# Columns added after the first version, added to older databases when opened
+ADDED = dict(retry='INTEGER')
+
+
+def percentile(values, num):
+    "Nearest rank percentile of sorted values"
+    rank = math.ceil(num / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class RunDB:
+    '''SQLite database of runs in the state folder
+    Runs are added from the supervisor thread, so the connection is shared under a lock
+    readonly = only read the runs, for the stats command on a folder it can't write to'''
+
+    def __init__(self, folder, readonly=False):
+        self.filename = os.path.join(folder, FILENAME)
+        self.lock = threading.Lock()
+        if readonly:
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(self.filename)),
+                                        uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            # Readers like the stats command don't block the scheduler and a crash loses at most the last run
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SCHEMA)
+        self.columns = {row[1] for row in self.conn.execute('PRAGMA table_info(runs)')}
+        if not readonly:
+            for name, kind in ADDED.items():
+                if name not in self.columns:
+                    self.conn.execute('ALTER TABLE runs ADD COLUMN {} {}'.format(name, kind))
+                    self.columns.add(name)
+
+
+    def add(self, job, run):
+        "Save a run record from the supervisor"
+        try:
+            with self.lock, self.conn:
+                self.conn.execute('INSERT INTO runs (job, {}) VALUES (?, {})'.format(
+                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                                  [job] + [run.get(name) for name in COLUMNS])
+        except sqlite3.Error as e:
+            warn("Could not save run of", job, "to", self.filename, e)
+
+
+    def stats(self, job=None, days=30):
+        '''Return a dict of job name to statistics over the last days
+        runs, failures, timeouts, retries, failure rate and runtime percentiles'''
+        query = 'SELECT job, elapsed, code, {}, user, system, read_bytes, write_bytes FROM runs WHERE start >= ?'.format(
+            'retry' if 'retry' in self.columns else '0')
+        args = [time.time() - days * 86400]
+        if job:
+            query += ' AND job = ?'
+            args.append(job)
+        with self.lock:
+            rows = self.conn.execute(query, args).fetchall()
+
+        jobs = {}
+        for name, elapsed, code, retry, user, system, read, write in rows:
+            jobs.setdefault(name, []).append((elapsed, code, retry, (user or 0) + (system or 0), (read or 0) + (write or 0)))
+
+        out = {}
+        for name, runs in jobs.items():
+            times = sorted(run[0] for run in runs)
+            failures = sum(1 for run in runs if run[1] != 0)
+            out[name] = dict(runs=len(runs),
+                             failures=failures,
+                             timeouts=sum(1 for run in runs if run[1] is None),
+                             retries=sum(1 for run in runs if run[2]),
+                             rate=failures / len(runs),
+                             p50=percentile(times, 50),
+                             p95=percentile(times, 95),
+                             max=times[-1],
+                             cpu=sum(run[3] for run in runs) / len(runs),
+                             disk=sum(run[4] for run in runs) / len(runs),
+                             )
+        return out
+
+
+    def jobs(self,):
+        "Return the names of every job with a run saved"
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT DISTINCT job FROM runs ORDER BY job')]
+
+
+    def close(self,):
+        with self.lock:
+            self.conn.close()
+
+
+def show_stats(stats):
+    "Print the output of RunDB.stats as a table"
+    out = [['Job', 'Runs', 'Failed', 'Timeouts', 'Retries', 'Fail %', 'p50', 'p95', 'Max', 'Cpu/run', 'Disk/run']]
+    for name, stat in sorted(stats.items()):
+        out.append([name, stat['runs'], stat['failures'], stat['timeouts'], stat['retries'],
+                    sig(100 * stat['rate'], 3), fmt_time(stat['p50']), fmt_time(stat['p95']), fmt_time(stat['max']),
+                    sig(stat['cpu'], 3) + 's', rfs(stat['disk'])])
+    auto_cols(out)
+
+
+def main():
+    "Entry point for: LazyCron.py stats"
+    args = [\
+    ['days', '', float, 30],
+    "How many days back to look",
+    ['state', '', str, '~/.local/state/LazyCron'],
+    "Folder with the run database, same as LazyCron --state",
+    ]
+    positionals = [\
+    ['job', '', str, ''],
+    "Only show this job, the name is matched exactly",
+    ]
+    uargs = easy_parse(args,
+                       positionals,
+                       usage='stats <job name>, --options...',
+                       description='Show runtime percentiles and failure rates from the run history.')
+
+    folder = os.path.abspath(os.path.expanduser(uargs.state))
+    if not os.path.exists(os.path.join(folder, FILENAME)):
+        print("No run history in", folder)
+        return
+    db = RunDB(folder, readonly=True)
+    stats = db.stats(uargs.job or None, uargs.days)
+    if stats:
+        show_stats(stats)
+    elif uargs.job:
+        print("No runs of", repr(uargs.job), "in the last", uargs.days, "days. Jobs found:")
+        print('\n'.join(db.jobs()))
+    else:
+        print("No runs in the last", uargs.days, "days")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# Sample system counters in the background so usage rates are always ready
+
+import math
+import time
+import threading
+from array import array
+
+from sd.common import qwarn as warn
+
+
+HISTORY = 3600              # Seconds of samples to keep
+
+
+class RingBuffer:
+    "Fixed number of (time, value) samples, the oldest are overwritten"
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.pos = 0                # Where the next sample goes
+        self.count = 0              # Samples stored
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, when, value):
+        self.times[self.pos] = when
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+
+    def _index(self, num):
+        "Position in the arrays of sample number num, 0 = oldest"
+        return (self.pos - self.count + num) % self.size
+
+
+    def last(self,):
+        "Return the newest (time, value)"
+        i = self._index(self.count - 1)
+        return self.times[i], self.values[i]
+
+
+    def find(self, when):
+        "Return the sample number of the newest sample at or before when, None if all samples are newer"
+        lo, hi = 0, self.count
+        # Times always increase, so search in oldest to newest order
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self._index(mid)] <= when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1 if lo else None
+
+
+    def get(self, num):
+        "Return (time, value) of sample number num, 0 = oldest"
+        i = self._index(num)
+        return self.times[i], self.values[i]
+
+
+class Sampler:
+    '''Read counters with a function every interval and keep them in ring buffers
+    read = function returning a dict of name: cumulative counter or current level
+    history = seconds of samples to keep'''
+
+    def __init__(self, read, interval=1, history=HISTORY):
+        self.read = read
+        self.interval = interval
+        self.size = int(history / interval) + 1
+        self.buffers = {}                   # Counter name to RingBuffer
+        self.lock = threading.Lock()
+        self.ready = threading.Event()      # Set once there are two samples to compare
+        self.cache = {}                     # Statistics already worked out since the last sample
+        self.thread = None
+        self.active = threading.Event()     # Cleared while paused
+
+
+    def start(self,):
+        "Take the first sample and start the sampling thread"
+        if self.thread:
+            return
+        self.active.set()
+        self.sample()
+        self.thread = threading.Thread(target=self.loop, daemon=True, name='sampler')
+        self.thread.start()
+
+
+    def pause(self,):
+        "Stop sampling until resume(), the samples so far are dropped so rates don't span the gap"
+        self.active.clear()
+        with self.lock:
+            self.buffers = {}
+            self.cache = {}
+        self.ready.clear()
+
+
+    def resume(self,):
+        if not self.active.is_set():
+            self.active.set()
+            self.sample()
+
+
+    def warm(self, timeout=None):
+        "Wait until rates are available, returns right away while paused"
+        self.start()
+        if not self.active.is_set():
+            return True
+        return self.ready.wait(timeout if timeout is not None else self.interval * 3)
+
+
+    def sample(self,):
+        "Read the counters once and store them"
+        try:
+            counters = self.read()
+        except (OSError, ValueError) as e:
+            warn("Could not read system counters:", e)
+            return
+        now = time.monotonic()
+        with self.lock:
+            if not self.active.is_set():
+                # Paused while reading
+                return
+            for name, value in counters.items():
+                if name not in self.buffers:
+                    self.buffers[name] = RingBuffer(self.size)
+                self.buffers[name].append(now, value)
+            self.cache = {}
+        if not self.ready.is_set() and any(len(buf) >= 2 for buf in self.buffers.values()):
+            self.ready.set()
+
+
+    def loop(self,):
+        while True:
+            self.active.wait()
+            # Keep to the interval without drifting
+            start = time.monotonic()
+            while self.active.is_set():
+                time.sleep(self.interval - (time.monotonic() - start) % self.interval)
+                self.sample()
+
+
+    def has(self, name):
+        "Is anything being recorded for name?"
+        with self.lock:
+            return name in self.buffers
+
+
+    def first(self, buf, seconds, need=None):
+        '''Return the sample number where the last seconds start in buf,
+        None if the samples don't go back need seconds yet (default = all of the seconds)'''
+        # Samples drift a little from the interval, so the newest one before end - seconds may be a bit late
+        end_time = buf.last()[0] + self.interval / 2
+        if buf.find(end_time - (seconds if need is None else need)) is None:
+            return None
+        return buf.find(end_time - seconds) or 0
+
+
+    def delta(self, name, seconds, need=None):
+        "Return (change in value, change in time) over the last seconds, or None without enough samples"
+        with self.lock:
+            buf = self.buffers.get(name)
+            if not buf or len(buf) < 2:
+                return None
+            end_time, end = buf.last()
+            num = self.first(buf, seconds, need)
+            if num is None:
+                return None
+            start_time, start = buf.get(min(num, len(buf) - 2))
+        return end - start, end_time - start_time
+
+
+    def rate(self, name, seconds, need=None):
+        "Average change per second over the last seconds"
+        delta = self.delta(name, seconds, need)
+        if delta is None:
+            return None
+        change, elapsed = delta
+        # Counters that go backwards were reset (device removed and so on)
+        return max(change, 0) / elapsed if elapsed else 0
+
+
+    def ratio(self, part, whole, seconds, need=None):
+        "Change in part as a percentage of the change in whole (cpu busy time over total time)"
+        part = self.delta(part, seconds, need)
+        whole = self.delta(whole, seconds, need)
+        if part is None or whole is None:
+            return None
+        # Part can go below zero when it's a difference of counters read at slightly different times
+        return max(100 * part[0] / whole[0], 0) if whole[0] > 0 else 0
+
+
+    def series(self, name, seconds, whole=None, need=None):
+        '''Return (times, rates) for each sample interval over the last seconds, None without enough samples
+        With whole, the rates are the change in name as a percentage of the change in whole
+        need = seconds of samples required, default = all of the seconds'''
+        with self.lock:
+            buf = self.buffers.get(name)
+            if not buf or len(buf) < 2:
+                return None
+            first = self.first(buf, seconds, need)
+            if first is None:
+                return None
+            samples = [buf.get(num) for num in range(min(first, len(buf) - 2), len(buf))]
+            if whole:
+                wbuf = self.buffers.get(whole)
+                if not wbuf or len(wbuf) < len(samples):
+                    return None
+                # Both counters are read at the same time, so line them up from the newest sample
+                wsamples = [wbuf.get(len(wbuf) - len(samples) + num) for num in range(len(samples))]
+
+        times = []
+        rates = []
+        for num in range(1, len(samples)):
+            (start, val), (end, val2) = samples[num - 1], samples[num]
+            change = max(val2 - val, 0)
+            if whole:
+                total = wsamples[num][1] - wsamples[num - 1][1]
+                rates.append(100 * change / total if total > 0 else 0)
+            else:
+                rates.append(change / (end - start) if end > start else 0)
+            times.append(end)
+        return times, rates
+
+
+    def samples(self, name, seconds, need=None):
+        "Return (times, values) of the samples in the last seconds, None without enough samples"
+        with self.lock:
+            buf = self.buffers.get(name)
+            if not buf:
+                return None
+            first = self.first(buf, seconds, need)
+            if first is None:
+                return None
+            samples = [buf.get(num) for num in range(first, len(buf))]
+        return [sample[0] for sample in samples], [sample[1] for sample in samples]
+
+
+    def stat(self, name, seconds, stat='avg', whole=None, partial=False):
+        '''Return a statistic of the rate over the last seconds, None until the samples cover the seconds
+        avg  = average rate over the whole time
+        max  = highest rate of any sample interval, so the limit held for the whole time
+        pNN  = NN percentile of the sample intervals
+        ewma = exponentially weighted average with seconds as the time constant, using up to 5 time constants
+        partial = use the samples there are until they cover the seconds, for a default window right after startup'''
+        key = (name, seconds, stat, whole, partial)
+        cache = self.cache                  # Replaced with an empty one on the next sample
+        if key in cache:
+            return cache[key]
+
+        need = 0 if partial else seconds
+        if stat == 'avg':
+            val = self.ratio(name, whole, seconds, need) if whole else self.rate(name, seconds, need)
+        else:
+            found = self.series(name, seconds * 5 if stat == 'ewma' else seconds, whole, need)
+            if found is None:
+                return None
+            val = summarize(*found, stat, seconds)
+        cache[key] = val
+        return val
+
+
+    def level(self, name, seconds, stat='last', partial=False):
+        '''Return a statistic of the value itself (free memory, load average) over the last seconds
+        last = newest sample, min = lowest sample, otherwise the same as stat()'''
+        key = (name, seconds, stat, 'level', partial)
+        cache = self.cache
+        if key in cache:
+            return cache[key]
+
+        if stat == 'last':
+            with self.lock:
+                buf = self.buffers.get(name)
+                val = buf.last()[1] if buf else None
+        else:
+            found = self.samples(name, seconds * 5 if stat == 'ewma' else seconds, need=0 if partial else seconds)
+            if found is None:
+                return None
+            val = summarize(*found, stat, seconds)
+        cache[key] = val
+        return val
+
+
+def summarize(times, values, stat, seconds):
+    "Return the max, min, avg, ewma or pNN percentile of a list of values"
+    if stat == 'max':
+        return max(values)
+    if stat == 'min':
+        return min(values)
+    if stat == 'avg':
+        return sum(values) / len(values)
+    if stat == 'ewma':
+        val = values[0]
+        for num in range(1, len(values)):
+            val += (1 - math.exp(-(times[num] - times[num - 1]) / seconds)) * (values[num] - val)
+        return val
+    # Nearest rank percentile
+    values = sorted(values)
+    rank = math.ceil(float(stat[1:]) / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# Save parsed schedule lines so a restart doesn't have to parse them again
+
+import os
+import sys
+import pickle
+import hashlib
+
+import scheduler
+from journal import write_atomic
+from sd.common import mkdir, qwarn as warn
+
+
+CACHE_VERSION = 2           # Increase when the format of App.definition() changes
+
+# Code that parses schedule lines, a change to any of these throws out the cache
+PARSERS = ('scheduler.py', 'LazyCron.py', 'policy.py', 'cgroups.py')
+
+
+def context(extra=''):
+    "Anything besides the line itself that changes how it's parsed"
+    return '\n'.join((str(CACHE_VERSION),
+                      sys.version,
+                      *(str(os.path.getmtime(os.path.join(os.path.dirname(scheduler.__file__), name)))
+                        for name in PARSERS),
+                      os.getcwd(),
+                      os.environ.get('PATH', ''),
+                      str(extra),
+                      ))
+
+
+class ScheduleCache:
+    '''Parsed App definitions keyed by the raw schedule line
+    The whole cache is thrown out if the interpreter, parsing code or --reqs change'''
+
+    def __init__(self, folder, extra=''):
+        mkdir(folder)
+        self.filename = os.path.join(folder, 'schedule.cache')
+        self.context = hashlib.sha1(context(extra).encode()).hexdigest()
+        self.digest = None          # Hash of the schedule text when cache was saved
+        self.order = []             # Schedule lines in order for that text
+        self.lines = {}             # Raw line to (args, definition)
+        self.changed = False
+        self.load()
+
+
+    def load(self,):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:      # pylint: disable=broad-except
+            warn("Could not read schedule cache:", self.filename, e)
+            return
+        if data.get('context') == self.context:
+            self.digest = data['digest']
+            self.order = data['order']
+            self.lines = data['lines']
+
+
+    def get_lines(self, text):
+        "Return the list of schedule lines from cache if text is unchanged, otherwise None"
+        if self.digest and self.digest == hashlib.sha1(text.encode()).hexdigest():
+            return self.order
+        return None
+
+
+    def get(self, line):
+        "Return (args, definition) for a raw schedule line or None"
+        return self.lines.get(line)
+
+
+    def put(self, line, app):
+        "Save the parsed app for a raw schedule line"
+        self.lines[line] = (app.args, app.definition())
+        self.changed = True
+
+
+    def save(self, text, order):
+        "Save the cache for schedule text with lines in order, dropping any lines no longer used"
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if not self.changed and digest == self.digest:
+            return
+        self.lines = {line: self.lines[line] for line in order if line in self.lines}
+        self.digest = digest
+        self.order = order
+        data = dict(context=self.context, digest=digest, order=order, lines=self.lines)
+        try:
+            write_atomic(self.filename, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError as e:
+            warn("Could not write schedule cache:", self.filename, e)
+        self.changed = False
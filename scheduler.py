@@ -3,137 +3,205 @@
 import os
 import re
 import csv
+import json
 import time
 import gzip
 import shutil
 import bisect
+import collections
+import hashlib
 import shlex
 import random
 import tarfile
 import datetime
-import subprocess
 from datetime import datetime as dada
 
 import shared
+import sampler
 import sd.chronology as chronos
 
 from shared import aprint
 from timewatch import get_idle
+from profiler import PROFILE
+from policy import parse_sched, parse_ioclass, parse_cpus
+from supervisor import SUPERVISOR, parse_weights
 
 from sd.msgbox import msgbox
-from sd.columns import indenter
-from sd.common import safe_filename, error, check_internet, spawn, quickrun
-from sd.common import search_list, DotDict, qwarn as warn, unique_filename, ConvertDataSize, rfs
+from sd.columns import indenter, auto_cols
+from sd.common import safe_filename, error, check_internet, sig
+from sd.common import search_list, DotDict, qwarn as warn, ConvertDataSize, rfs
+
+
+RUN_RECORDS = 100           # Recent runs to keep the resource usage of for each App
 
 
 class Reqs:
     "User requirements field"
 
-    def __init__(self,):
-        # Requirements measured in units of time
-        self.time_reqs = ('idle', 'busy', 'elapsed', 'today', 'random', 'timeout', 'delay', 'loopdelay')
-
-        # Requirements measured in KB, MB...
-        self.data_reqs = ('disk', 'network')
-
-        # String only
-        self.string_reqs = ('ssid', 'environs')
-
-        # Requirements to run processes, These are default values if no argument given by user
-        self.reqs = DotDict(plugged=True,
-                            unplugged=True,
-                            idle=10 * 60,
-                            busy=10 * 60,
-                            elapsed=10 * 60,
-                            closed=True,
-                            open=True,
-                            random=86400,
-                            start=1,
-                            retry=3,
-                            loop=0,
-                            lowbatt=10,
-                            minbatt=50,
-                            shell=True,
-                            wake=True,
-                            suspend=True,
-                            environs='',
-                            loopdelay=1,
-                            delay=60,
-                            delaymult=2,
-                            timeout=3600,
-                            nologs=True,
-                            noerrs=True,
-                            localdir=True,
-                            online=True,
-                            today=10 * 60,
-                            skip=1,
-                            ssid="",
-                            max=0,
-                            reps=1,
-                            nice=8,
-                            disk=shared.LOW_DISK,
-                            network=shared.LOW_NET,
-                            cpu=shared.LOW_CPU,
-                            )
-
-        # Aliases to self.reqs
-        self.aliases = dict(plug='plugged',
-                            unplug='unplugged',
-                            lazy='idle',
-                            rand='random',
-                            startup='start',
-                            no_logs='nologs',
-                            local_dir='localdir',
-                            shut='closed',
-                            low_batt='lowbatt',
-                            batt='lowbatt',
-                            battery='lowbatt',
-                            highbatt='minbatt',
-                            minbattery='minbatt',
-                            wait='delay',
-                            wifi='ssid',
-                            noerrors='noerrs',
-                            no_errs='noerrs',
-                            no_errors='noerrs',
-                            sleep='suspend',
-                            slept='suspend',
-                            unsuspend='wake',
-                            woke='wake',
-                            environmentals='environs',
-                            doubler='delaymult',
-                            retrydelay='loopdelay',
-                            retry_delay='loopdelay',
-                            loop_delay='loopdelay',
-                            doubledelay='delaymult',
-                            multdelay='delaymult',
-                            lan='ssid',
-                            kill='timeout',
-                            skipped='skip',
-                            internet='online',
-                            used='busy',
-                            usage='busy',
-                            maximum='max',
-                            disc='disk',
-                            repititions='reps',
-                            repetitions='reps',
-                            )
-
-
-        # Swap plugged with unplugged and so on...
-        self.inversions = dict(unplugged='plugged', open='closed')
-
-        # Needed programs to use named reqs
-        self.needed = dict(network='sar', disk='iostat')
-        assert all([key in self.reqs for key in self.needed])
-
-        #
-        assert all([key in self.reqs for key in self.time_reqs + self.data_reqs + self.string_reqs])
-
-        # Check for errors in reqs:
-        # No repeats between aliases and real reqs
-        assert not set(self.aliases.keys()) & set(self.reqs.keys())
-        # All values in aliases are legit reqs
-        assert all([val in self.reqs.keys() for val in self.aliases.values()])
+    # Requirements measured in units of time
+    time_reqs = ('idle', 'busy', 'elapsed', 'today', 'random', 'timeout', 'grace', 'delay', 'loopdelay')
+
+    # Requirements measured in KB, MB...
+    data_reqs = ('disk', 'network', 'iomax')
+
+    # Amounts of memory in KB, MB...
+    size_reqs = ('mem', 'swap', 'memmax')
+
+    # String only
+    string_reqs = ('ssid', 'environs', 'weight', 'sched', 'ioclass', 'cpus')
+
+    # Usage reqs can be measured over time: cpu 10 over 5m, disk 1M p90 10m
+    usage_reqs = ('cpu', 'disk', 'network', 'mem', 'swap', 'load', 'cpupressure', 'iopressure', 'mempressure')
+
+    # Can be limited to a device or path: disk /mnt/backup 5M, or network interfaces: network wlan* !tun0 50K
+    target_reqs = ('disk', 'network')
+
+    # Words for the statistic used by usage reqs, pNN is also accepted for percentiles
+    stat_words = dict(over='max', max='max', avg='avg', mean='avg', average='avg', ewma='ewma')
+
+    # Can leave out the usage of LazyCron's own programs: disk 5M foreign
+    foreign_reqs = ('cpu', 'disk', 'network')
+    scope_words = dict(foreign='foreign', others='foreign', total='total', all='total')
+
+    # Requirements to run processes, These are default values if no argument given by user
+    defaults = dict(plugged=True,
+                    unplugged=True,
+                    idle=10 * 60,
+                    busy=10 * 60,
+                    elapsed=10 * 60,
+                    closed=True,
+                    open=True,
+                    random=86400,
+                    start=1,
+                    retry=3,
+                    loop=0,
+                    lowbatt=10,
+                    minbatt=50,
+                    shell=True,
+                    wake=True,
+                    suspend=True,
+                    environs='',
+                    loopdelay=1,
+                    delay=60,
+                    delaymult=2,
+                    timeout=3600,
+                    grace='10 seconds',     # Same as supervisor.GRACE
+                    nologs=True,
+                    noerrs=True,
+                    localdir=True,
+                    online=True,
+                    today=10 * 60,
+                    skip=1,
+                    ssid="",
+                    max=0,
+                    reps=1,
+                    nice=8,
+                    disk=shared.LOW_DISK,
+                    network=shared.LOW_NET,
+                    cpu=shared.LOW_CPU,
+                    mem=1e9,
+                    swap=100e6,
+                    load=0.5,
+                    weight='io 1',
+                    cpupressure=10,
+                    iopressure=10,
+                    mempressure=10,
+                    cpumax=100,
+                    memmax=1e9,
+                    iomax=10e6,
+                    pids=64,
+                    idleclass=True,
+                    sched='idle',
+                    ioclass='idle',
+                    cpus='0',
+                    oom=500,
+                    )
+
+    # Aliases to reqs
+    aliases = dict(plug='plugged',
+                   unplug='unplugged',
+                   lazy='idle',
+                   rand='random',
+                   startup='start',
+                   no_logs='nologs',
+                   local_dir='localdir',
+                   shut='closed',
+                   low_batt='lowbatt',
+                   batt='lowbatt',
+                   battery='lowbatt',
+                   highbatt='minbatt',
+                   minbattery='minbatt',
+                   wait='delay',
+                   wifi='ssid',
+                   noerrors='noerrs',
+                   no_errs='noerrs',
+                   no_errors='noerrs',
+                   sleep='suspend',
+                   slept='suspend',
+                   unsuspend='wake',
+                   woke='wake',
+                   environmentals='environs',
+                   doubler='delaymult',
+                   retrydelay='loopdelay',
+                   retry_delay='loopdelay',
+                   loop_delay='loopdelay',
+                   doubledelay='delaymult',
+                   multdelay='delaymult',
+                   lan='ssid',
+                   kill='timeout',
+                   killgrace='grace',
+                   skipped='skip',
+                   internet='online',
+                   used='busy',
+                   usage='busy',
+                   maximum='max',
+                   disc='disk',
+                   repititions='reps',
+                   repetitions='reps',
+                   weights='weight',
+                   slot='weight',
+                   slots='weight',
+                   memory='mem',
+                   ram='mem',
+                   freemem='mem',
+                   loadavg='load',
+                   cpupsi='cpupressure',
+                   iopsi='iopressure',
+                   mempsi='mempressure',
+                   memorypressure='mempressure',
+                   cpulimit='cpumax',
+                   memlimit='memmax',
+                   iolimit='iomax',
+                   diskmax='iomax',
+                   maxpids='pids',
+                   tasks='pids',
+                   idle_class='idleclass',
+                   background='idleclass',
+                   policy='sched',
+                   scheduler='sched',
+                   ionice='ioclass',
+                   ioprio='ioclass',
+                   affinity='cpus',
+                   cpuset='cpus',
+                   oomscore='oom',
+                   oom_score_adj='oom',
+                   )
+
+
+    # Swap plugged with unplugged and so on...
+    inversions = dict(unplugged='plugged', open='closed')
+
+    # Needed programs to use named reqs (usage reqs read /proc or use psutil, so none for now)
+    needed = dict()
+
+    # Pressure stall reqs and the file they need in /proc/pressure
+    pressure_reqs = dict(cpupressure='cpu', iopressure='io', mempressure='memory')
+
+    def __init__(self, reqs=None, usage_args=None):
+        "reqs = already processed reqs, otherwise start with the defaults"
+        self.reqs = DotDict(self.defaults if reqs is None else reqs)
+        self.usage_args = dict(usage_args or {})    # Req name to arguments for Busy when measuring usage reqs
+
 
     def __call__(self, value):
         if value in self.reqs:
@@ -144,6 +212,7 @@ class Reqs:
 
     def reset(self,):
         self.reqs = DotDict()
+        self.usage_args = {}
 
 
     def print(self,):
@@ -152,6 +221,8 @@ class Reqs:
         for key, val in sorted(self.reqs.items()):
             if key in self.data_reqs:
                 val = rfs(val) + '/s'
+            if key in self.size_reqs:
+                val = rfs(val)
             if key in self.time_reqs and val >= 300:
                 val = chronos.fmt_time(val)
             out[key] = val
@@ -168,9 +239,20 @@ class Reqs:
 
         if req in self.needed:
             return check(self.needed[req])
+        if req in self.pressure_reqs and not os.path.exists(os.path.join('/proc/pressure', self.pressure_reqs[req])):
+            warn("Pressure stall information is not available, ignoring the", req, "req")
+            return False
         return True
 
 
+    def recheck(self,):
+        "Drop reqs that can't be used anymore, for reqs loaded from the schedule cache"
+        for req in list(self.reqs):
+            if not self.req_okay(req):
+                del self.reqs[req]
+                self.usage_args.pop(req, None)
+
+
     def get_environs(self):
         "Special handling for environs"
         if 'environs' in self.reqs:
@@ -185,13 +267,64 @@ class Reqs:
             self.reqs.environs = out
 
 
+    def get_weights(self):
+        "Convert the weight req to a dict of budget names to weights"
+        if 'weight' in self.reqs:
+            self.reqs.weight = parse_weights(self.reqs.weight)
+
+
+    def get_policy(self):
+        "Check the scheduling reqs and convert them to the values used in the child"
+        if 'sched' in self.reqs:
+            val = parse_sched(self.reqs.sched)
+            if val is None:
+                error("Unknown scheduling policy:", self.reqs.sched, "Expected idle, batch or other")
+            self.reqs.sched = val
+        if 'ioclass' in self.reqs:
+            val = parse_ioclass(self.reqs.ioclass)
+            if val is None:
+                error("Unknown io class:", self.reqs.ioclass, "Expected idle, be <0-7>, rt <0-7> or a number")
+            self.reqs.ioclass = val
+        if 'cpus' in self.reqs:
+            val = parse_cpus(self.reqs.cpus)
+            if val is None:
+                error("Expected a list of cpus like 0-3,6 not:", self.reqs.cpus)
+            self.reqs.cpus = val
+        if 'oom' in self.reqs and not -1000 <= self.reqs.oom <= 1000:
+            error("oom must be between -1000 and 1000")
+
+
+    @classmethod
+    def split_usage(cls, words):
+        '''Split the words after a usage req like disk /mnt/backup 5M p90 10m into (target, value, stat, window, scope)
+        The value starts with a number like 5M or .5M, anything before it is the target
+        scope = foreign to leave out LazyCron's own programs, total to count them, None for the default'''
+        start = len(words)
+        for index, word in enumerate(words):
+            if re.match(r'\.?\d', word):
+                start = index
+                break
+        target = ' '.join(words[:start])
+        rest = [word.lower() for word in words[start:]]
+        scopes = [word for word in rest if word in cls.scope_words]
+        rest = [word for word in rest if word not in cls.scope_words]
+        scope = cls.scope_words[scopes[-1]] if scopes else None
+        for index, word in enumerate(rest):
+            if word in cls.stat_words or re.fullmatch(r'p\d+(\.\d+)?', word):
+                stat = cls.stat_words.get(word, word)
+                return target, ' '.join(rest[:index]), stat, ' '.join(rest[index + 1:]), scope
+        return target, ' '.join(rest), None, '', scope
+
+
     def process_reqs(self, args):
         "Process requirements field"
         found = []
+        usage = dict()              # Arguments for Busy when measuring usage reqs
 
         for arg in args:
             if not arg.strip():
                 continue
+            words = arg.strip().split()[1:]           # Keep case for paths
             split = arg.lower().strip().split()
             arg = split[0].rstrip(':')
             val = (' '.join(split[1:])).strip().rstrip('%')
@@ -205,6 +338,29 @@ class Reqs:
             if not self.req_okay(match):
                 continue
 
+            if match in self.usage_reqs:
+                target, val, stat, window, scope = self.split_usage(words)
+                val = val.strip().rstrip('%')
+                kargs = dict()
+                if target:
+                    if match not in self.target_reqs:
+                        error(match, "can't be limited to", target)
+                    kargs['target'] = target
+                if stat:
+                    if stat.startswith('p') and not 0 < float(stat[1:]) <= 100:
+                        error("Percentile must be between 0 and 100:", stat)
+                    window = chronos.convert_user_time(window, default='minutes') if window else None
+                    if window and window > sampler.HISTORY:
+                        error("Usage can only be measured over the last", chronos.fmt_time(sampler.HISTORY))
+                    kargs['stat'] = stat
+                    kargs['window'] = window
+                if scope:
+                    if match not in self.foreign_reqs:
+                        error(match, "can't leave out LazyCron's own programs")
+                    kargs['foreign'] = scope == 'foreign'
+                if kargs:
+                    usage[match] = kargs
+
             # Get default value if not supplied
             if not val:
                 val = self.reqs[match]
@@ -221,13 +377,13 @@ class Reqs:
                 val = chronos.convert_user_time(val, default='minutes')
             elif match in ('plugged', 'closed', 'online'):
                 val = bool(val)
-            elif match in self.data_reqs:
+            elif match in self.data_reqs + self.size_reqs and isinstance(val, str):
                 val = re.sub('second[s]*', 's', val)
                 val = re.sub('[/\\\\]*[s]$', '', val)
                 val = ConvertDataSize()(val)
             elif match in self.string_reqs:
                 val = val.strip("'").strip('"').strip()
-            else:
+            elif isinstance(val, str):
                 # Numeric conversions
                 try:
                     val = int(val)
@@ -245,8 +401,25 @@ class Reqs:
         for key in list(self.reqs.keys()):
             if key not in found:
                 del self.reqs[key]
+        self.usage_args = usage
 
         self.get_environs()
+        self.get_weights()
+        self.get_policy()
+
+
+def _verify_reqs():
+    "Check for errors in reqs"
+    reqs = Reqs.defaults
+    assert all([key in reqs for key in Reqs.needed])
+    assert all([key in reqs for key in Reqs.time_reqs + Reqs.data_reqs + Reqs.string_reqs])
+    # No repeats between aliases and real reqs
+    assert not set(Reqs.aliases.keys()) & set(reqs.keys())
+    # All values in aliases are legit reqs
+    assert all([val in reqs.keys() for val in Reqs.aliases.values()])
+
+
+_verify_reqs()
 
 
 def process_date(src):
@@ -278,6 +451,11 @@ def process_date(src):
     return start, end, cycle
 
 
+def line_key(args):
+    "Hash of a schedule line's fields"
+    return hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()[:16]
+
+
 def next_day(day, cycle, today=None):
     "Given a process_date formatted data, return the next occurence"
     if not today:
@@ -319,8 +497,12 @@ def add_cycle(date, cycle, count=1):
 class App:
     "Spawn processes during windows of time when certain conditions are met"
 
-    def __init__(self, args):
-        "Defaults:"
+    # Parsed values that define an App, everything else is runtime state
+    DEFINITION = ('window', 'date_window', 'freq', 'elapsed_freq', 'cmd', 'name')
+
+    def __init__(self, args, definition=None):
+        '''Defaults:
+        definition = output of App.definition() to skip parsing args'''
         self.window = []            # Start and stop times
         self.date_window = []       # Allowed days
         self.start = 0              # Start time in UTC
@@ -334,15 +516,33 @@ class App:
         self.elapsed_next = 0       # Next time allowed to run by elapsed_freq
 
         self.args = args            # Preserve initial setup args
-        self.thread = None          # Thread starting running process
+        self.key = line_key(args)   # Stable identity for this line
+        self.job = None             # Future for the job in the supervisor
+        self.runs = collections.deque(maxlen=RUN_RECORDS)     # Times, exit code and resources used by recent runs
         self.verbose = shared.VERBOSE
 
-        self.reqs = Reqs()
-        self.process_args()                         # Process data lines
-        self.cmd = self.process_path(args['path'])
+        if definition:
+            for name in self.DEFINITION:
+                setattr(self, name, definition[name])
+            self.reqs = Reqs(definition['reqs'], definition['usage_args'])
+            # Installed programs and kernel features can change between restarts
+            self.reqs.recheck()
+            self.elapsed_next = self.elapsed_freq
+        else:
+            self.reqs = Reqs()
+            self.process_args()                         # Process data lines
+            self.cmd = self.process_path(args['path'])
         self.calc_window()
 
 
+    def definition(self):
+        "Return the parsed values of the App as plain data for the schedule cache"
+        out = {name: getattr(self, name) for name in self.DEFINITION}
+        out['reqs'] = dict(self.reqs.reqs)
+        out['usage_args'] = self.reqs.usage_args
+        return out
+
+
     def process_path(self, path):
         "Process the command line path from args"
 
@@ -493,7 +693,7 @@ class App:
 
     def running(self):
         "Check if process is already running."
-        if self.thread and self.thread.is_alive():
+        if self.job and not self.job.done():
             return True
         return False
         # Search system wide
@@ -609,6 +809,22 @@ class App:
             else:
                 print('...' + ', '.join(history[-10:]))
 
+    def show_runs(self,):
+        "Print the resources used by recent runs"
+        out = [['Started', 'Time', 'Code', 'User cpu', 'Sys cpu', 'Peak mem', 'Read', 'Written', 'Switches']]
+        for run in self.runs:
+            row = [chronos.local_time(run.start, '%m-%d %H:%M:%S'), chronos.fmt_time(run.elapsed),
+                   'timeout' if run.code is None else run.code]
+            if 'user' in run:
+                row += [sig(run.user, 3), sig(run.system, 3), rfs(run.maxrss) if run.maxrss else '', rfs(run.read_bytes),
+                        rfs(run.write_bytes), run.nvcsw + run.nivcsw]
+            out.append(row)
+        if len(out) > 1:
+            auto_cols(out)
+        else:
+            print("No runs recorded for", self.name)
+
+
     def alert(self, *args, v=3):
         "Show time, process name and message"
         if self.verbose >= v:
@@ -616,6 +832,84 @@ class App:
             aprint(*args, '::', self.name, )
 
 
+    def inherit(self, parent):
+        "Carry on the history of an App replaced by an edited schedule line"
+        self.history = list(parent.history)
+        self.runs.extend(parent.runs)
+        if not self.history:
+            return
+        # Recalculate the next run from the last run with the new frequency
+        last = self.history[-1]
+        if self.freq is None:
+            self.next_run = last + 86400 - chronos.seconds_since_midnight(last)
+        elif self.freq:
+            self.next_run = last + self.freq
+        if self.elapsed_freq and parent.elapsed_freq:
+            self.elapsed_next = parent.elapsed_next - parent.elapsed_freq + self.elapsed_freq
+
+
+    def session_runs(self):
+        "Number of runs since LazyCron started (history may be loaded from a previous session)"
+        return len(self.history) - bisect.bisect_left(self.history, shared.START_TIME)
+
+
+    def count_reps(self):
+        "Return the number of runs in the current window and the time it started"
+        # Start time if in window, otherwise midnight:
+        start = self.start if self.start else time.time() - chronos.seconds_since_midnight()
+        count = len(self.history) - bisect.bisect_left(self.history, start)
+
+        # Fixed bug where skipped runs counted towards reps
+        if 'skip' in self.reqs.reqs:
+            count -= self.reqs.reqs.skip
+        return count, start
+
+
+    def next_eligible(self, twatch, polling_rate):
+        '''Return the earliest time that ready() and check_reqs() could possibly pass.
+        Idle, elapsed and usage time can't grow faster than the clock, so their remaining
+        thresholds are added to now. Everything else (cpu, lid, random...) can change at
+        any moment and is checked again after polling_rate.'''
+        now = time.time()
+        inf = float('inf')
+        reqs = self.reqs.reqs
+
+        # Only run with special flags or never again
+        if 'wake' in reqs or 'suspend' in reqs:
+            return inf
+        if 'start' in reqs and self.session_runs() >= reqs.start:
+            return inf
+        if 'max' in reqs and len(self.history) >= reqs.max:
+            return inf
+
+        if self.running():
+            return now + polling_rate
+
+        bounds = [self.next_run]
+        if self.window or self.date_window:
+            self.in_window()                    # Recalculates a stale window
+            bounds.append(self.start)
+        if self.elapsed_freq:
+            bounds.append(now + self.elapsed_next - twatch.elapsed)
+
+        if 'idle' in reqs:
+            bounds.append(now + reqs.idle - twatch.idle)
+        if 'busy' in reqs:
+            bounds.append(now + reqs.busy - twatch.usage())
+        if 'elapsed' in reqs:
+            bounds.append(now + reqs.elapsed - twatch.elapsed)
+        if 'today' in reqs:
+            bounds.append(now + reqs.today - twatch.today_elapsed)
+        if 'reps' in reqs and self.count_reps()[0] >= reqs.reps:
+            # Reps only reset when a new window opens
+            bounds.append(self.stop if self.window or self.date_window else inf)
+
+        deadline = max(bounds)
+        if deadline > now:
+            return deadline
+        return now + polling_rate
+
+
     def check_reqs(self, twatch, polling_rate, busy, flag=None):
         '''Check App requirements, Return True if all okay
            flag = special keywords to run script like: 'wake', 'suspend'
@@ -635,7 +929,7 @@ class App:
 
             # Usage requirements:
             if 'idle' in reqs:
-                if twatch.idle < reqs.idle or get_idle() < reqs.idle:
+                if twatch.idle < reqs.idle or PROFILE.call('reqs:idle', get_idle) < reqs.idle:
                     self.alert("Idle time not reached")
                     return False
             if 'busy' in reqs and twatch.usage() < reqs.busy:
@@ -653,54 +947,62 @@ class App:
                 return False
 
             # History requirements:
-            if 'start' in reqs and len(self.history) >= reqs.start:
+            if 'start' in reqs and self.session_runs() >= reqs.start:
                 return False
             if 'max' in reqs and len(self.history) >= reqs.max:
                 self.alert("Max number of times reached")
                 return False
             if 'reps' in reqs:
-
-                # Start time if in window, otherwise midnight:
-                start = self.start if self.start else time.time() - chronos.seconds_since_midnight()
-                count = len(self.history) - bisect.bisect_left(self.history, start)
-
-                # Fixed bug where skipped runs counted towards reps
-                if 'skip' in reqs:
-                    count -= reqs.skip
-
+                count, start = PROFILE.call('reqs:reps', self.count_reps)
                 if count >= reqs.reps:
                     self.alert("Max number of reps reached:", count, 'since', chronos.local_time(start))
                     return False
 
             # Machine requirements:
-            for name, func in [('cpu', busy.get_cpu), ('disk', busy.get_disk), ('network', busy.get_net)]:
+            usage = self.reqs.usage_args
+
+            def measure(name, func):
+                "Get the current usage for a req, None = sampler not ready yet"
+                return PROFILE.call('reqs:' + name, func, **usage.get(name, {}))
+
+            for name, func in [('cpu', busy.get_cpu), ('disk', busy.get_disk), ('network', busy.get_net),
+                               ('swap', busy.get_swap), ('load', busy.get_load),
+                               ('cpupressure', busy.get_cpu_pressure),
+                               ('iopressure', busy.get_io_pressure),
+                               ('mempressure', busy.get_mem_pressure)]:
                 if name in reqs:
-                    val = func()
+                    val = measure(name, func)
                     if val is None:
-                        # None value = thread not ready yet
                         return False
                     if val >= reqs[name]:
                         self.alert(name, "usage too high to continue")
                         return False
 
+            if 'mem' in reqs:
+                val = measure('mem', busy.get_mem)
+                if val is None or val < reqs.mem:
+                    self.alert("Not enough free memory")
+                    return False
+
             # State requirements:
             # Keep last to avoid unnecessary checks
-            if 'closed' in reqs and reqs.closed == shared.COMP.lid_open():
+            comp = shared.COMP
+            if 'closed' in reqs and reqs.closed == PROFILE.call('reqs:closed', comp.lid_open):
                 self.alert("Wrong lid state")
                 return False
-            if 'plugged' in reqs and reqs.plugged != shared.COMP.plugged_in():
+            if 'plugged' in reqs and reqs.plugged != PROFILE.call('reqs:plugged', comp.plugged_in):
                 self.alert("Wrong plug state")
                 return False
-            if 'ssid' in reqs and reqs.ssid.lower() != shared.COMP.get_ssid().lower():
+            if 'ssid' in reqs and reqs.ssid.lower() != PROFILE.call('reqs:ssid', comp.get_ssid).lower():
                 self.alert("Wrong network id")
                 return False
-            if 'online' in reqs and not check_internet():
+            if 'online' in reqs and not PROFILE.call('reqs:online', check_internet):
                 self.alert("Not Online")
                 return False
-            if 'lowbatt' in reqs and shared.COMP.get_charge() > reqs.lowbatt:
+            if 'lowbatt' in reqs and PROFILE.call('reqs:battery', comp.get_charge) > reqs.lowbatt:
                 self.alert("Battery too high")
                 return False
-            if 'minbatt' in reqs and shared.COMP.get_charge() < reqs.minbatt:
+            if 'minbatt' in reqs and PROFILE.call('reqs:battery', comp.get_charge) < reqs.minbatt:
                 self.alert("Battery too low")
                 return False
 
@@ -711,7 +1013,7 @@ class App:
         "Is the process ready to be run?"
 
         # Check if process is already running.
-        if self.thread and self.thread.is_alive():
+        if self.running():
             self.alert("Still running!")
             return False
 
@@ -733,7 +1035,7 @@ class App:
 
 
     def run(self, twatch, testing_mode, skip_mode=False):
-        "Run the process in seperate thread while writing output to log."
+        "Run the process in the supervisor while writing output to log."
         now = time.time()
 
         if not (skip_mode and self.start):
@@ -756,186 +1058,33 @@ class App:
 
         # Must be in run to trigger self.next_run
         reqs = self.reqs.reqs
-        if 'skip' in reqs and len(self.history) <= reqs.skip:
-            self.alert("Skip", len(self.history), 'of', reqs.skip, v=2)
+        if 'skip' in reqs and self.session_runs() <= reqs.skip:
+            self.alert("Skip", self.session_runs(), 'of', reqs.skip, v=2)
             return False
 
         if self.cmd[0].lstrip().startswith('#'):
             testing_mode = True
         if testing_mode:
-            text = "Did not start process"
+            self.alert("Did not start process", v=1)
             started = False
         else:
-            text = "Started process"
             started = True
             filename = safe_filename(self.name + '.' + str(int(now)))
-            _, self.thread = spawn(run_thread,
-                                   self.cmd,
-                                   log=os.path.abspath(os.path.join(shared.LOG_DIR, filename)),
-                                   reqs=self.reqs,
-                                   name=self.name,
-                                   )
-
-        self.alert(text, v=1)
+            self.job = SUPERVISOR.submit(self.cmd,
+                                         log=os.path.abspath(os.path.join(shared.LOG_DIR, filename)),
+                                         reqs=self.reqs,
+                                         name=self.name,
+                                         record=self.runs.append,
+                                         # Jobs may wait in line for a slot before starting
+                                         started=lambda: self.alert("Started process", v=1),
+                                         expires=self.stop if self.window or self.date_window else None,
+                                         )
+
         if self.verbose >= 2:
             self.show_history()
         return started
 
 
-def run_thread(cmd, log, reqs, name):
-    "Run a command in it's own thread, and save stdout and stderr"
-
-    time.sleep(reqs('delay') or 0)
-    if reqs('nice'):
-        os.nice(reqs('nice') - shared.NICE)
-
-    retry = reqs('retry')
-
-    # Delay after each loop
-    loopdelay = reqs('loopdelay') if reqs('loopdelay') is not None else 60
-
-    # Default to doubling delay each time if running in retry mode
-    delaymult = reqs('delaymult')               # Multiply delay by this amount each time
-    if delaymult is None:
-        if retry:
-            delaymult = 2
-        else:
-            delaymult = 1
-
-    # Loop in retry and loop modes
-    counter = 0
-    loops = reqs('loop')
-
-    messages_sent = 0
-    def send_msg():
-        "Send message on error (only once)"
-        if code and messages_sent < 1:
-            if not reqs('noerrs'):
-                print()
-                warn(name, "\nReturned code", code)
-                warn("Errors in:", efilename)
-                quickrun('sd/msgbox.py', name, "returned code", str(code))
-            return 1
-        return 0
-
-    while True:
-        counter += 1
-
-        if counter >= 2:
-            loopdelay *= delaymult
-
-        # Code = None if terminated early, 0 on success, [Any other integer] on error
-        code, elapsed, efilename = run_proc(cmd, log, reqs, name, attempt=counter)
-
-        # Run this script again if requested (does not count toward reps)
-        if retry:
-            if code != 0 and (counter < retry or retry == 0):
-                time.sleep(loopdelay)
-                aprint("Retry", counter + 1, '::', name)
-                continue
-        if loops is not None:
-            messages_sent += send_msg()
-            if counter < loops or loops == 0:
-                time.sleep(loopdelay)
-                aprint("Loop", counter + 1, '::', name)
-                continue
-        break
-    messages_sent += send_msg()
-
-    if code == 0:
-        msg = ' '.join((name, 'finished after', chronos.fmt_time(elapsed)))
-        if counter > 1:
-            msg += " on run number " + str(counter)
-        aprint(msg.strip())
-
-
-def run_proc(cmd, log, reqs, name, attempt):
-    "Actually run the process"
-
-    # Set output and error files
-    folder, file = os.path.split(log)
-    log = os.path.join(folder, safe_filename(file))
-
-    if attempt >= 2:
-        log = log + '.' + str(attempt)
-
-    ofilename = unique_filename(log + '.log')
-    efilename = unique_filename(log + '.err')
-    ofile = open(ofilename, mode='a')
-    efile = open(efilename, mode='a')
-    timeout = reqs('timeout')
-    start = time.perf_counter()
-
-
-    def wait(seconds=None):
-        "Wait for subprocess to finish, return None if timeout expires"
-        try:
-            return ret.wait(seconds)
-        except subprocess.TimeoutExpired:
-            return None
-
-    if not shared.SHOWPID:
-        # subprocess.run method
-        try:
-            ret = subprocess.run(cmd, check=False, stdout=ofile, stderr=efile,
-                                 cwd=os.path.dirname(cmd[0]) if reqs('localdir') else None,
-                                 shell=reqs('shell') or False,
-                                 timeout=timeout,
-                                 env=reqs('environs') or os.environ,
-                                 )
-            code = ret.returncode
-        except subprocess.TimeoutExpired:
-            code = None
-
-    else:
-        # subprocess.Popen method
-        ret = subprocess.Popen(cmd, stdout=ofile, stderr=efile,
-                               cwd=os.path.dirname(cmd[0]) if reqs('localdir') else None,
-                               shell=reqs('shell') or False,
-                               env=reqs('environs') or os.environ,
-                               )
-
-
-        # Show pid after 2 seconds
-        if timeout and timeout < 2:
-            code = wait(timeout)
-        else:
-            code = wait(2)
-            if code is None:
-                print('pid =', ret.pid, 'for', name)
-                if timeout:
-                    code = wait(timeout - 2)
-                else:
-                    code = wait()
-
-    if code is None:
-        aprint("Timeout reached for", name)
-
-
-    # Close output files
-    elapsed = time.perf_counter() - start
-    oflag = bool(ofile.tell())      # Does the file have data in it?
-    eflag = bool(efile.tell())
-    ofile.close()
-    efile.close()
-
-
-    # Remove logs if returned 0
-    if code == 0 and bool(reqs('nologs')):
-        if oflag:
-            os.remove(ofilename)
-        if eflag:
-            os.remove(efilename)
-    else:
-        # Remove file if nothing was written to them
-        if not oflag:
-            os.remove(ofilename)
-        if not eflag:
-            os.remove(efilename)
-
-    return code, elapsed, efilename
-
-
 def compress_logs(dirname, minimum=5, month=-1, overwrite=False, exts=('.log', '.err')):
     '''Add last months log files to tar.gz
     minimum = min number of files to compress (and delete)
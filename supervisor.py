@@ -0,0 +1,509 @@
+#!/usr/bin/python3
+# Run every job in a single asyncio event loop instead of a thread per job
+# Children are waited on with pidfds (linux 5.3+) or polled if those aren't available
+
+import os
+import re
+import time
+import signal
+import asyncio
+import threading
+import subprocess
+import functools
+import collections
+
+import shared
+import sd.chronology as chronos
+
+from shared import aprint
+from metrics import METRICS
+from how_busy_linux import read_io
+from cgroups import Cgroups, CONTROLLERS, join_cgroup, set_rlimit
+from policy import steps as policy_steps
+from sd.common import safe_filename, unique_filename, quickrun, DotDict, qwarn as warn
+
+
+POLL = 0.5                  # Seconds between checks on a child without pidfds
+GRACE = 10                  # Seconds between SIGTERM and SIGKILL at timeout, unless set by the grace req
+
+
+def parse_weights(text):
+    '''Convert text like 'io 2 cpu' to {'io': 2, 'cpu': 1}
+    A number without a name is the weight for the global jobs budget'''
+    out = {}
+    name = None
+    for word in re.split(r'[\s=:,$]+', (text or '').lower().strip()):
+        if not word:
+            continue
+        try:
+            out[name or 'jobs'] = float(word)
+            name = None
+            continue
+        except ValueError:
+            pass
+        if name:
+            out[name] = 1
+        name = word
+    if name:
+        out[name] = 1
+    return out
+
+
+class Slots:
+    '''Concurrency budgets shared by all jobs. Names without a limit are unlimited.
+    Jobs that don't fit wait in line, first come first served.
+    Only use from inside the event loop.'''
+
+    def __init__(self, limits=None):
+        self.limits = {}                            # Budget name to capacity
+        self.used = collections.Counter()           # Budget name to weight in use
+        self.waiting = collections.deque()          # (need, future) for jobs waiting for a slot
+        self.configure(limits or {})
+
+
+    def configure(self, limits):
+        "Set the capacity of each budget, 0 = no limit"
+        self.limits = {name: val for name, val in limits.items() if val}
+
+
+    def need(self, weights):
+        "Return what a job with weights (from the weight req) needs from each limited budget"
+        need = dict(jobs=1)
+        need.update(weights or {})
+        # A job bigger than the whole budget gets all of it instead of waiting forever
+        return {name: min(val, self.limits[name]) for name, val in need.items()
+                if name in self.limits and val > 0}
+
+
+    def fits(self, need):
+        return all(self.used[name] + val <= self.limits[name] for name, val in need.items())
+
+
+    def _take(self, need):
+        for name, val in need.items():
+            self.used[name] += val
+
+
+    async def acquire(self, need, name=''):
+        "Wait until the budgets have room for need"
+        if not self.waiting and self.fits(need):
+            self._take(need)
+            return
+        aprint("Waiting for a slot ::", name, v=2)
+        future = asyncio.get_running_loop().create_future()
+        entry = (need, future)
+        self.waiting.append(entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+            elif future.done() and not future.cancelled():
+                self.release(need)
+            raise
+
+
+    def release(self, need):
+        "Return the budget used by a job and start whoever is next in line"
+        for name, val in need.items():
+            self.used[name] -= val
+        while self.waiting and self.fits(self.waiting[0][0]):
+            need, future = self.waiting.popleft()
+            if not future.done():
+                self._take(need)
+                future.set_result(None)
+
+
+def preexec(reqs, cgroup=None, rlimits=()):
+    '''Return a function to run in the child before exec, or None
+    The child is forked from a threaded process, so everything is worked out here and the child only makes syscalls.
+    A step that fails is skipped with a message in the job's error log instead of stopping the job.'''
+    steps = []
+    if reqs('nice'):
+        steps.append(('nice', functools.partial(os.nice, reqs('nice') - shared.NICE)))
+    if cgroup:
+        steps.append(('cgroup', functools.partial(join_cgroup, os.path.join(cgroup, 'cgroup.procs'))))
+    for limit, val in rlimits:
+        steps.append(('rlimit', functools.partial(set_rlimit, limit, val)))
+    steps += policy_steps(reqs)
+    if not steps:
+        return None
+    steps = [(b'LazyCron: Could not set ' + name.encode() + b', skipping it: ', step) for name, step in steps]
+
+    def run():
+        for msg, step in steps:
+            try:
+                step()
+            except (OSError, ValueError) as e:
+                os.write(2, msg + str(e).encode() + b'\n')
+    return run
+
+
+def has_exited(proc):
+    "Has the child exited? It's left unreaped so its counters can still be read"
+    if hasattr(os, 'waitid'):
+        try:
+            return os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+        except ChildProcessError:
+            return True
+    return proc.poll() is not None
+
+
+def usage(rusage, io):
+    '''Convert the rusage of a reaped child and its /proc/<pid>/io counters to the resources used by a run
+    ru_maxrss is left out, it counts the memory of LazyCron itself from before exec'''
+    return DotDict(user=rusage.ru_utime,                    # Cpu seconds
+                   system=rusage.ru_stime,
+                   maxrss=None,                             # Set from the job cgroup when there is one
+                   inblock=rusage.ru_inblock,               # Filesystem blocks read and written
+                   oublock=rusage.ru_oublock,
+                   nvcsw=rusage.ru_nvcsw,                   # Voluntary and involuntary context switches
+                   nivcsw=rusage.ru_nivcsw,
+                   read_bytes=io.get('read_bytes', rusage.ru_inblock * 512),
+                   write_bytes=io.get('write_bytes', rusage.ru_oublock * 512),
+                   )
+
+
+def reap(proc):
+    '''Reap an exited child and return (exit code, resources used or None)
+    Includes everything it started that was waited on, which is normally the whole tree'''
+    try:
+        # Only readable until the child is reaped
+        io = read_io(proc.pid)
+    except (OSError, ValueError):
+        io = {}
+    try:
+        _pid, status, rusage = os.wait4(proc.pid, 0)
+    except (AttributeError, ChildProcessError):
+        # Already reaped by proc.poll()
+        return proc.wait(), None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, usage(rusage, io)
+
+
+def signal_group(pgid, sig):
+    "Send a signal to every process in a group, return False if none are left"
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # A member changed users, the rest still get the signal
+        pass
+    return True
+
+
+def group_running(pgid):
+    "Are any processes in the group still running? Zombies waiting for init to reap them don't count"
+    if not signal_group(pgid, 0):
+        return False
+    if not os.path.isdir('/proc/self'):
+        return True
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open(os.path.join('/proc', name, 'stat')) as f:
+                    # state, parent pid, group id
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[2]) == pgid and fields[0] != 'Z':
+                return True
+    return False
+
+
+class Supervisor:
+    '''Owns all of the running jobs
+    The event loop runs in one daemon thread and is started by the first submit()'''
+
+    def __init__(self,):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.jobs = 0                   # Jobs submitted and not finished yet
+        self.slots = Slots()
+        self.rundb = None               # RunDB to save every run in
+        self.cgroups = Cgroups()        # Resource caps for jobs
+
+
+    def start(self,):
+        "Start the event loop thread"
+        with self.lock:
+            if self.loop:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='supervisor')
+            self.thread.start()
+
+
+    def submit(self, cmd, log, reqs, name, record=None, started=None, expires=None):
+        '''Start a job in the event loop
+        record = function called with a DotDict of the times, exit code and resources used by each run
+        started = function called when the job gets a slot and starts
+        expires = unix time after which a job still waiting for a slot is dropped, like the end of its window
+        Returns a concurrent.futures.Future, check if the job is running with future.done()'''
+        self.start()
+        # Decremented in the event loop thread
+        with self.lock:
+            self.jobs += 1
+        future = asyncio.run_coroutine_threadsafe(self.run_job(cmd, log, reqs, name, record, started, expires),
+                                                  self.loop)
+        future.add_done_callback(self._finished)
+        return future
+
+
+    def _finished(self, future):
+        with self.lock:
+            self.jobs -= 1
+        if not future.cancelled() and future.exception():
+            warn("Supervisor error:", repr(future.exception()))
+
+
+    async def run_job(self, cmd, log, reqs, name, record=None, started=None, expires=None):
+        "Run a command with delay, loop and retry, and save stdout and stderr"
+
+        await asyncio.sleep(reqs('delay') or 0)
+
+        retry = reqs('retry')
+
+        # Delay after each loop
+        loopdelay = reqs('loopdelay') if reqs('loopdelay') is not None else 60
+
+        # Default to doubling delay each time if running in retry mode
+        delaymult = reqs('delaymult')               # Multiply delay by this amount each time
+        if delaymult is None:
+            if retry:
+                delaymult = 2
+            else:
+                delaymult = 1
+
+        # Loop in retry and loop modes
+        counter = 0
+        loops = reqs('loop')
+        code = None
+        efilename = None
+        retrying = False                            # Is this run a retry of a failed one?
+
+        messages_sent = 0
+        async def send_msg():
+            "Send message on error (only once)"
+            if code and messages_sent < 1:
+                if not reqs('noerrs'):
+                    print()
+                    warn(name, "\nReturned code", code)
+                    warn("Errors in:", efilename)
+                    # The message box waits for the user, so keep it out of the event loop
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, quickrun, 'sd/msgbox.py', name, "returned code", str(code))
+                return 1
+            return 0
+
+        while True:
+            counter += 1
+
+            if counter >= 2:
+                loopdelay *= delaymult
+
+            # Code = None if terminated early, 0 on success, [Any other integer] on error
+            need = self.slots.need(reqs('weight'))
+            await self.slots.acquire(need, name)
+            if counter == 1:
+                if expires and time.time() > expires:
+                    self.slots.release(need)
+                    aprint("Window closed while waiting for a slot, not starting ::", name)
+                    return
+                if started:
+                    started()
+            try:
+                code, elapsed, efilename = await self.run_proc(cmd, log, reqs, name, counter, record, retrying)
+            finally:
+                self.slots.release(need)
+
+            # Run this script again if requested (does not count toward reps)
+            if retry:
+                if code != 0 and (counter < retry or retry == 0):
+                    await asyncio.sleep(loopdelay)
+                    aprint("Retry", counter + 1, '::', name)
+                    retrying = True
+                    continue
+            if loops is not None:
+                messages_sent += await send_msg()
+                if counter < loops or loops == 0:
+                    await asyncio.sleep(loopdelay)
+                    aprint("Loop", counter + 1, '::', name)
+                    retrying = False
+                    continue
+            break
+        messages_sent += await send_msg()
+
+        if code == 0:
+            msg = ' '.join((name, 'finished after', chronos.fmt_time(elapsed)))
+            if counter > 1:
+                msg += " on run number " + str(counter)
+            aprint(msg.strip())
+
+
+    async def run_proc(self, cmd, log, reqs, name, attempt, record=None, retry=False):
+        "Actually run the process, retry = started again because the last run failed"
+
+        # Set output and error files
+        folder, file = os.path.split(log)
+        log = os.path.join(folder, safe_filename(file))
+
+        if attempt >= 2:
+            log = log + '.' + str(attempt)
+
+        ofilename = unique_filename(log + '.log')
+        efilename = unique_filename(log + '.err')
+        ofile = open(ofilename, mode='a')
+        efile = open(efilename, mode='a')
+        timeout = reqs('timeout')
+        start = time.perf_counter()
+        started = time.time()
+        used = None
+        cgroup, rlimits = self.limits(reqs, name)
+
+        try:
+            proc = subprocess.Popen(cmd, stdout=ofile, stderr=efile,
+                                    cwd=os.path.dirname(cmd[0]) if reqs('localdir') else None,
+                                    shell=reqs('shell') or False,
+                                    env=reqs('environs') or os.environ,
+                                    preexec_fn=preexec(reqs, cgroup, rlimits),
+                                    # Own process group so a timeout can stop everything the job started
+                                    start_new_session=True,
+                                    )
+        except (OSError, subprocess.SubprocessError) as e:
+            # Same as a failed exec in a shell
+            efile.write(str(e) + '\n')
+            proc = None
+            code = 127
+
+        if proc:
+            METRICS.inc('lazycron_job_starts_total', job=name)
+            if shared.SHOWPID:
+                asyncio.get_running_loop().call_later(
+                    2, lambda: proc.poll() is None and print('pid =', proc.pid, 'for', name))
+            grace = reqs('grace')
+            code, used = await self.wait(proc, timeout, GRACE if grace is None else grace)
+
+        if code is None:
+            aprint("Timeout reached for", name)
+        if cgroup:
+            if used:
+                used.maxrss = self.cgroups.peak(cgroup)
+            self.cgroups.remove(cgroup)
+
+
+        # Close output files
+        elapsed = time.perf_counter() - start
+        result = 'timeout' if code is None else 'ok' if code == 0 else 'error'
+        METRICS.inc('lazycron_job_finishes_total', job=name, result=result)
+        if code != 0:
+            METRICS.inc('lazycron_job_failures_total', job=name)
+        METRICS.observe('lazycron_job_runtime_seconds', elapsed, job=name)
+        run = DotDict(used or {}, start=started, end=time.time(), elapsed=elapsed, code=code, attempt=attempt,
+                      retry=int(retry))
+        if record:
+            record(run)
+        if self.rundb:
+            self.rundb.add(name, run)
+        oflag = bool(ofile.tell())      # Does the file have data in it?
+        eflag = bool(efile.tell())
+        ofile.close()
+        efile.close()
+
+
+        # Remove logs if returned 0
+        if code == 0 and bool(reqs('nologs')):
+            if oflag:
+                os.remove(ofilename)
+            if eflag:
+                os.remove(efilename)
+        else:
+            # Remove file if nothing was written to them
+            if not oflag:
+                os.remove(ofilename)
+            if not eflag:
+                os.remove(efilename)
+
+        return code, elapsed, efilename
+
+
+    def limits(self, reqs, name):
+        "Return (cgroup path, rlimits) to enforce the cpumax, memmax, iomax and pids reqs"
+        limits = {req: reqs(req) for req in CONTROLLERS if reqs(req)}
+        if not limits:
+            return None, ()
+        if self.cgroups.setup():
+            try:
+                return self.cgroups.create(name, limits), ()
+            except OSError as e:
+                warn("Could not create a cgroup for", name, e)
+        return None, self.cgroups.rlimits(limits)
+
+
+    async def wait(self, proc, timeout=None, grace=GRACE):
+        '''Wait for a child to exit and return (code, resources used), the code is None if it was killed at timeout
+        At timeout the whole process group gets SIGTERM, then SIGKILL after grace seconds'''
+        try:
+            return await asyncio.wait_for(self.wait_exit(proc), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        # The child is the leader of its own group, so the group id is its pid
+        pgid = proc.pid
+        signal_group(pgid, signal.SIGTERM)
+        killed = False
+        try:
+            _code, used = await asyncio.wait_for(self.wait_exit(proc), grace)
+        except asyncio.TimeoutError:
+            signal_group(pgid, signal.SIGKILL)
+            killed = True
+            _code, used = await self.wait_exit(proc)
+
+        # Programs started in the background can outlive the leader
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + grace
+        while group_running(pgid):
+            if loop.time() >= deadline:
+                if killed:
+                    warn("Processes started by", proc.args, "are still running after SIGKILL")
+                    break
+                signal_group(pgid, signal.SIGKILL)
+                killed = True
+                deadline = loop.time() + grace
+            await asyncio.sleep(0.1)
+        return None, used
+
+
+    @staticmethod
+    async def wait_exit(proc):
+        "Wait for a child to exit without blocking the event loop, return (code, resources used)"
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+
+        if pidfd is None:
+            while not has_exited(proc):
+                await asyncio.sleep(POLL)
+            return reap(proc)
+
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+
+        def readable():
+            if not exited.done():
+                exited.set_result(None)
+
+        loop.add_reader(pidfd, readable)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        # The pidfd is readable once the child exits, so this won't block
+        return reap(proc)
+
+
+SUPERVISOR = Supervisor()
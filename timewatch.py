@@ -2,11 +2,12 @@
 
 import sys
 import time
+import threading
 import subprocess
 
 import shared
 from sd.common import warn, check_install
-from sd.chronology import local_time, fmt_time, msleep
+from sd.chronology import local_time, fmt_time
 
 PLATFORM = shared.PLATFORM
 
@@ -45,13 +46,15 @@ def get_idle():
 class TimeWatch:
     "Keep track of idle time, even when computer sleeps"
 
-    def __init__(self, verbose=0):
+    def __init__(self, verbose=0, step=60):
         self.idle = 0                           # Seconds of idle time
         self.elapsed = 0                        # Total time Computer has spent in usage
         self.increase = 0                       # Increase in elapsed from last call
         self._inuse_start = 0                       # Contiguous usage time start
         self.today_elapsed = 0                  # Elapsed just for today
         self.verbose = verbose
+        self._wakeup = threading.Event()        # Set to end sleep early
+        self.step = step                        # Most seconds between idle checks during a long sleep
 
     def reset(self):
         "Reset counters on new day"
@@ -66,15 +69,43 @@ class TimeWatch:
             return 0
 
 
-    def sleep(self, seconds):
-        "Sleep for seconds and track missing time"
-        if seconds <= 0:
-            return 0
+    def wake(self):
+        "Interrupt the current sleep, (Can be called from another thread)"
+        self._wakeup.set()
+
+
+    def sleep(self, seconds, accuracy=1/60):
+        '''Sleep for seconds (or until woken) and track missing time
+        Long sleeps check the idle time every step, so short breaks in use aren't counted as use
+        Returns early after missing time, so the caller can handle waking up'''
+        missing = 0
+        end = time.monotonic() + seconds
+        while not missing:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            missing, woken = self._sleep(min(remaining, self.step), accuracy)
+            if woken:
+                break
+        return missing
+
 
+    def _sleep(self, seconds, accuracy):
+        '''Sleep for one step, update the idle and elapsed counters and return (missing time, woken early)
+        The monotonic clock doesn't advance while the computer is suspended,
+        so the difference between it and the wall clock is the missing time.'''
         start = time.time()
-        missing = msleep(seconds)
+        mono = time.monotonic()
+        woken = self._wakeup.wait(seconds)
+        self._wakeup.clear()
         end = time.time()
 
+        # Use the time actually slept when woken up early
+        seconds = max(time.monotonic() - mono, 1e-3)
+        missing = end - start - seconds
+        if missing / seconds <= accuracy:
+            missing = 0
+
         # If there is missing time during sleep it most likely indicates computer went to sleep
         if missing / seconds > 0.05:
             if missing > seconds:
@@ -110,7 +141,7 @@ class TimeWatch:
             if self.verbose >= 4:
                 self.status()
 
-        return missing
+        return missing, woken
 
     def status(self,):
         fmt = lambda x: fmt_time(x if x > 0.1 else 0, digits=2)
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# Watch the schedule file for changes with inotify (linux) or by polling its stat
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+import shared
+from sd.common import qwarn as warn
+
+
+# From /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+# Editors either write the file in place or write a temp file and rename it over the original
+DIR_EVENTS = IN_CLOSE_WRITE | IN_MODIFY | IN_ATTRIB | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT = struct.Struct('iIII')       # wd, mask, cookie, len of name
+
+
+def load_inotify():
+    "Return libc if it has inotify, otherwise None"
+    if shared.PLATFORM != 'linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    '''Watch a file and call wake() when it changes.
+    Uses inotify on the folder holding the file (and the folder of its real path if it's a link),
+    so atomic rename on save is caught. Falls back to checking the file stat every interval,
+    also when a watched folder is moved or deleted.'''
+
+    def __init__(self, filename, wake=None, interval=60, settle=0.2):
+        self.filename = os.path.abspath(filename)
+        self.wake = wake                        # Function to call on change
+        self.interval = interval                # Polling interval without inotify
+        self.settle = settle                    # Wait for more events before calling wake
+        self.changed = True                     # Start by reading the file
+        self.lock = threading.Lock()
+        self.fd = None
+        self.names = {}                         # Watch descriptor to filenames in that folder
+        self.lost = False                       # A watched folder went away
+
+        libc = load_inotify()
+        if libc and self._start_inotify(libc):
+            self.method = 'inotify'
+            target = self._inotify_loop
+        else:
+            self.method = 'stat'
+            self.stat = self._stat()
+            target = self._stat_loop
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+
+    def _start_inotify(self, libc):
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            warn("inotify_init failed:", os.strerror(ctypes.get_errno()))
+            return False
+
+        paths = {self.filename, os.path.realpath(self.filename)}
+        for path in paths:
+            folder, name = os.path.split(path)
+            wd = libc.inotify_add_watch(self.fd, folder.encode(), DIR_EVENTS)
+            if wd < 0:
+                warn("Could not watch", folder, os.strerror(ctypes.get_errno()))
+                os.close(self.fd)
+                self.fd = None
+                return False
+            # A link in the same folder as its target gets the same watch descriptor
+            self.names.setdefault(wd, set()).add(name.encode())
+        return True
+
+
+    def check(self,):
+        "Return True once after each change"
+        with self.lock:
+            changed = self.changed
+            self.changed = False
+        return changed
+
+
+    def _changed(self,):
+        with self.lock:
+            self.changed = True
+        if self.wake:
+            self.wake()
+
+
+    def _read_events(self,):
+        "Read pending inotify events, return True if any were about the file"
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return False
+            raise
+        found = False
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, _cookie, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size: pos + EVENT.size + length].rstrip(b'\0')
+            pos += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                found = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # The folder itself went away, nothing more will come from this watch
+                self.lost = True
+                found = True
+            elif name in self.names.get(wd, ()):
+                found = True
+        return found
+
+
+    def _inotify_loop(self,):
+        while True:
+            select.select([self.fd], [], [])
+            if not self._read_events():
+                continue
+            # Let the editor finish saving before waking up the main loop
+            while select.select([self.fd], [], [], self.settle)[0]:
+                self._read_events()
+            self._changed()
+            if self.lost:
+                break
+
+        # The folder may come back later, which only polling will notice
+        warn("Folder holding", self.filename, "was moved or deleted. Checking it every",
+             self.interval, "seconds instead.")
+        os.close(self.fd)
+        self.fd = None
+        self.method = 'stat'
+        self.stat = self._stat()
+        self._stat_loop()
+
+
+    def _stat(self,):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+    def _stat_loop(self,):
+        while True:
+            time.sleep(self.interval)
+            stat = self._stat()
+            if stat and stat != self.stat:
+                self.stat = stat
+                self._changed()